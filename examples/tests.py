@@ -32,13 +32,16 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+from django.core.exceptions import FieldError
 from django.db import connections, router
 from django.db.models import Q
 from django.test import TestCase
 
 import ldap
+import select
 
-from ldapdb.backends.ldap.compiler import query_as_ldap
+from ldapdb.backends.ldap.compiler import query_as_ldap, query_target
+from ldapdb.models import BulkError, ConflictError
 from examples.models import LdapUser, LdapGroup
 
 class BaseTestCase(TestCase):
@@ -120,10 +123,10 @@ class GroupTestCase(BaseTestCase):
 
         # AND filter
         qs = LdapGroup.objects.filter(gid=1000, name='foogroup')
-        self.assertEquals(query_as_ldap(qs.query), '(&(objectClass=posixGroup)(&(gidNumber=1000)(cn=foogroup)))')
+        self.assertEquals(query_as_ldap(qs.query), '(&(objectClass=posixGroup)(gidNumber=1000)(cn=foogroup))')
 
         qs = LdapGroup.objects.filter(Q(gid=1000) & Q(name='foogroup'))
-        self.assertEquals(query_as_ldap(qs.query), '(&(objectClass=posixGroup)(&(gidNumber=1000)(cn=foogroup)))')
+        self.assertEquals(query_as_ldap(qs.query), '(&(objectClass=posixGroup)(gidNumber=1000)(cn=foogroup))')
 
         # OR filter
         qs = LdapGroup.objects.filter(Q(gid=1000) | Q(name='foogroup'))
@@ -141,7 +144,17 @@ class GroupTestCase(BaseTestCase):
         self.assertEquals(query_as_ldap(qs.query), '(&(objectClass=posixGroup)(!(&(gidNumber=1000)(cn=foogroup))))')
 
         qs = LdapGroup.objects.filter(name='foogroup').exclude(gid=1000)
-        self.assertEquals(query_as_ldap(qs.query), '(&(objectClass=posixGroup)(&(cn=foogroup)(!(gidNumber=1000))))')
+        self.assertEquals(query_as_ldap(qs.query), '(&(objectClass=posixGroup)(cn=foogroup)(!(gidNumber=1000)))')
+
+        # equality terms come first, duplicates are dropped
+        qs = LdapGroup.objects.filter(name__startswith='foo', gid=1000).filter(gid=1000)
+        self.assertEquals(query_as_ldap(qs.query), '(&(objectClass=posixGroup)(gidNumber=1000)(cn=foo*))')
+
+        # an empty __in does not need a search
+        qs = LdapGroup.objects.filter(name__in=[])
+        self.assertEquals(query_as_ldap(qs.query), None)
+        self.assertEquals(len(qs), 0)
+        self.assertEquals(qs.count(), 0)
 
     def test_filter(self):
         qs = LdapGroup.objects.filter(name='foogroup')
@@ -163,6 +176,18 @@ class GroupTestCase(BaseTestCase):
         qs = LdapGroup.objects.filter(name='does_not_exist')
         self.assertEquals(len(qs), 0)
 
+    def test_exists(self):
+        self.assertTrue(LdapGroup.objects.all().exists())
+        self.assertTrue(LdapGroup.objects.filter(name='foogroup').exists())
+        self.assertFalse(LdapGroup.objects.filter(name='does_not_exist').exists())
+
+    def test_first(self):
+        g = LdapGroup.objects.order_by('name').first()
+        self.assertEquals(g.name, 'bargroup')
+
+        g = LdapGroup.objects.filter(name='does_not_exist').first()
+        self.assertEquals(g, None)
+
     def test_get(self):
         g = LdapGroup.objects.get(name='foogroup')
         self.assertEquals(g.dn, 'cn=foogroup,%s' % LdapGroup.base_dn)
@@ -216,12 +241,154 @@ class GroupTestCase(BaseTestCase):
         self.assertEquals(qs[1].name, 'foogroup')
         self.assertEquals(qs[2].name, 'bargroup')
 
+    def test_sort_rules(self):
+        qs = LdapGroup.objects.order_by('-name', 'gid')
+        compiler = qs.query.get_compiler(using=qs.db)
+        self.assertEquals(compiler.get_sort_rules(compiler.get_ordering()),
+                          ['-cn:caseIgnoreOrderingMatch', 'gidNumber:integerOrderingMatch'])
+
+        # fields without an ordering rule are sorted client side
+        self.assertEquals(compiler.get_sort_rules(['usernames']), None)
+        self.assertEquals(compiler.get_sort_rules(['dn']), None)
+
+    def test_sort_entries(self):
+        qs = LdapGroup.objects.order_by('-gid', 'name')
+        compiler = qs.query.get_compiler(using=qs.db)
+        entries = [('cn=%s' % name, {'cn': [name], 'gidNumber': [gid]})
+                   for name, gid in [('a', '1'), ('B', '3'), ('c', '2'), ('b', '3')]]
+        ordered = compiler.sort_entries(entries, compiler.get_ordering())
+        self.assertEquals([dn for dn, attrs in ordered],
+                          ['cn=B', 'cn=b', 'cn=c', 'cn=a'])
+
+        # only the top entries are selected for a slice
+        self.assertEquals(compiler.sort_entries(entries, compiler.get_ordering(), 2),
+                          ordered[:2])
+
+    def test_bulk_create(self):
+        groups = [LdapGroup(name='group1', gid=2000),
+                  LdapGroup(name='group2', gid=2001)]
+        objs = LdapGroup.objects.bulk_create(groups, batch_size=1)
+        self.assertEquals([g.dn for g in objs],
+                          ['cn=group1,%s' % LdapGroup.base_dn,
+                           'cn=group2,%s' % LdapGroup.base_dn])
+        self.assertEquals(LdapGroup.objects.count(), 5)
+
+        g = LdapGroup.objects.get(name='group2')
+        self.assertEquals(g.gid, 2001)
+
+        # failures are reported per object, the other entries are created
+        g1 = LdapGroup(name='foogroup', gid=1000)
+        g2 = LdapGroup(name='group3', gid=2002)
+        try:
+            LdapGroup.objects.bulk_create([g1, g2])
+        except BulkError as e:
+            self.assertEquals(len(e.errors), 1)
+            self.assertTrue(e.errors[0][0] is g1)
+            self.assertTrue(isinstance(e.errors[0][1], ldap.ALREADY_EXISTS))
+        else:
+            self.fail("BulkError not raised")
+        self.assertEquals(g1.dn, '')
+        self.assertEquals(g2.dn, 'cn=group3,%s' % LdapGroup.base_dn)
+        self.assertEquals(LdapGroup.objects.count(), 6)
+
     def test_bulk_delete(self):
         LdapGroup.objects.all().delete()
 
         qs = LdapGroup.objects.all()
         self.assertEquals(len(qs), 0)
 
+    def test_save_conflict(self):
+        g = LdapGroup.objects.get(name='foogroup')
+        other = LdapGroup.objects.get(name='foogroup')
+        other.gid = 1010
+        other.save()
+
+        # fields which were not changed concurrently can be saved
+        g.usernames = ['foouser']
+        g.save(check_conflicts=True)
+
+        g.gid = 1020
+        self.assertRaises(ConflictError, g.save, check_conflicts=True)
+
+        g = LdapGroup.objects.get(name='foogroup')
+        self.assertEquals(g.gid, 1010)
+        self.assertEquals(g.usernames, ['foouser'])
+
+    def test_save_unloaded(self):
+        # an instance which was not loaded is written in full
+        g = LdapGroup(dn='cn=foogroup,%s' % LdapGroup.base_dn,
+                      name='foogroup', gid=1000, usernames=[])
+        g.save()
+        g = LdapGroup.objects.get(name='foogroup')
+        self.assertEquals(g.usernames, [])
+        self.assertEquals(g.gid, 1000)
+
+    def test_save_refresh(self):
+        g = LdapGroup.objects.get(name='foogroup')
+        other = LdapGroup.objects.get(name='foogroup')
+        other.usernames = ['zoouser']
+        other.save()
+
+        g.gid = 1010
+        g.save(refresh=['usernames'])
+        self.assertEquals(g.gid, 1010)
+        self.assertEquals(g.usernames, ['zoouser'])
+
+        g = LdapGroup(name='newgroup', gid=1003)
+        g.save(refresh=True)
+        self.assertEquals(g.gid, 1003)
+        self.assertEquals(g.usernames, [])
+
+    def test_queryset_update(self):
+        count = LdapGroup.objects.filter(gid__gte=1001).update(usernames=['zoo'])
+        self.assertEquals(count, 2)
+
+        g = LdapGroup.objects.get(name='foogroup')
+        self.assertEquals(g.usernames, ['foouser', 'baruser'])
+        g = LdapGroup.objects.get(name='bargroup')
+        self.assertEquals(g.usernames, ['zoo'])
+
+        # empty values remove the attribute
+        count = LdapGroup.objects.filter(name='bargroup').update(usernames=[])
+        self.assertEquals(count, 1)
+        g = LdapGroup.objects.get(name='bargroup')
+        self.assertEquals(g.usernames, [])
+
+        self.assertRaises(FieldError, LdapGroup.objects.update, name='newgroup')
+
+    def test_delete_subtree(self):
+        connection = connections['ldap']
+        base = 'ou=tree,%s' % LdapGroup.base_dn
+        connection.add_s(base, [
+            ('objectClass', ['top', 'organizationalUnit']),
+            ('ou', ['tree'])])
+        connection.add_s('ou=sub,%s' % base, [
+            ('objectClass', ['top', 'organizationalUnit']),
+            ('ou', ['sub'])])
+        connection.add_s('cn=leaf,ou=sub,%s' % base, [
+            ('objectClass', ['top', 'posixGroup']),
+            ('cn', ['leaf']),
+            ('gidNumber', ['3000'])])
+
+        self.assertRaises(ldap.NOT_ALLOWED_ON_NONLEAF,
+                          connection.delete_many, [base])
+
+        # children are not listed from the search cache, which doesn't
+        # know about entries added by other clients
+        connection.settings_dict['CACHE'] = {}
+        try:
+            connection.search_s(base, ldap.SCOPE_SUBTREE, attrlist=['1.1'])
+            connection._cursor().connection.add_s(('cn=other,%s' % base).encode('utf-8'), [
+                ('objectClass', ['top', 'posixGroup']),
+                ('cn', ['other']),
+                ('gidNumber', ['3001'])])
+            connection.delete_many([base], subtree=True)
+        finally:
+            connection.get_search_cache().clear()
+            del connection.settings_dict['CACHE']
+        self.assertRaises(ldap.NO_SUCH_OBJECT, connection.search_s,
+                          base, ldap.SCOPE_BASE)
+
     def test_slice(self):
         qs = LdapGroup.objects.all()
         objs = list(qs)
@@ -259,6 +426,122 @@ class GroupTestCase(BaseTestCase):
         self.assertEquals(len(objs), 1)
         self.assertEquals(objs[0].gid, 1001)
 
+    def test_iterator(self):
+        qs = LdapGroup.objects.all()
+        it = qs.iterator()
+        self.assertFalse(isinstance(it, list))
+        objs = list(it)
+        self.assertEquals(len(objs), 3)
+        self.assertEquals(sorted(g.gid for g in objs), [1000, 1001, 1002])
+
+        qs = LdapGroup.objects.filter(name='does_not_exist')
+        self.assertEquals(list(qs.iterator()), [])
+
+    def test_search_async(self):
+        connection = connections[router.db_for_read(LdapGroup)]
+        names = ['foogroup', 'bargroup', 'wizgroup', 'does_not_exist']
+        searches = [connection.search_async(LdapGroup.base_dn, ldap.SCOPE_SUBTREE,
+                                            '(cn=%s)' % name, ['gidNumber'])
+                    for name in names]
+
+        results = dict((name, []) for name in names)
+        while not all(search.done for search in searches):
+            select.select([searches[0].fileno()], [], [], 1)
+            for name, search in zip(names, searches):
+                results[name].extend(search.poll())
+
+        self.assertEquals(results['foogroup'],
+                          [('cn=foogroup,%s' % LdapGroup.base_dn, {'gidNumber': ['1000']})])
+        self.assertEquals(len(results['bargroup']), 1)
+        self.assertEquals(len(results['wizgroup']), 1)
+        self.assertEquals(results['does_not_exist'], [])
+
+    def test_async_queryset(self):
+        def wait(handles):
+            while not all(handle.done for handle in handles):
+                select.select([handles[0].fileno()], [], [], 1)
+                for handle in handles:
+                    handle.poll()
+
+        groups = LdapGroup.objects.order_by('gid')[1:3].aiter()
+        count = LdapGroup.objects.acount()
+        sliced_count = LdapGroup.objects.all()[1:].acount()
+        foogroup = LdapGroup.objects.aget(name='foogroup')
+        wait([groups, count, sliced_count, foogroup])
+        self.assertEquals([g.name for g in groups.result], ['bargroup', 'wizgroup'])
+        self.assertEquals(count.result, 3)
+        self.assertEquals(sliced_count.result, 2)
+        self.assertEquals(foogroup.result.gid, 1000)
+
+        missing = LdapGroup.objects.aget(name='does_not_exist')
+        self.assertRaises(LdapGroup.DoesNotExist, wait, [missing])
+
+    def test_async_write(self):
+        def wait(handle):
+            while not handle.poll():
+                select.select([handle.fileno()], [], [], 1)
+
+        g = LdapGroup(name='newgroup', gid=1010)
+        wait(g.asave())
+        self.assertEquals(g.dn, 'cn=newgroup,%s' % LdapGroup.base_dn)
+        g.usernames = ['foouser']
+        wait(g.asave())
+        self.assertEquals(LdapGroup.objects.get(name='newgroup').usernames, ['foouser'])
+
+        g.name = 'renamedgroup'
+        self.assertRaises(ValueError, g.asave)
+        g.name = 'newgroup'
+
+        wait(g.adelete())
+        self.assertEquals(LdapGroup.objects.filter(name='newgroup').count(), 0)
+        self.assertRaises(ldap.NO_SUCH_OBJECT, wait, g.adelete())
+
+    def test_base_search(self):
+        dn = 'cn=foogroup,%s' % LdapGroup.base_dn
+        qs = LdapGroup.objects.filter(name='foogroup')
+        self.assertEquals(query_target(qs.query), (dn, '(&(objectClass=posixGroup)(cn=foogroup))'))
+        self.assertEquals(qs.get().gid, 1000)
+        self.assertEquals(LdapGroup.objects.get(dn=dn).name, 'foogroup')
+        self.assertEquals(LdapGroup.objects.filter(name='foogroup', gid=1001).count(), 0)
+        self.assertFalse(LdapGroup.objects.filter(name='does_not_exist').exists())
+
+        qs = LdapGroup.objects.filter(gid=1000)
+        self.assertEquals(query_target(qs.query), None)
+
+        # dn values are used as they are
+        dn = 'cn=Smith\\2C John,%s' % LdapGroup.base_dn
+        self.assertEquals(query_target(LdapGroup.objects.filter(dn=dn).query)[0], dn)
+        self.assertFalse(LdapGroup.objects.filter(name=u'grôupe').exists())
+
+    def test_in_chunks(self):
+        connection = connections[router.db_for_read(LdapGroup)]
+        connection.settings_dict['IN_CHUNK_SIZE'] = 1
+        try:
+            # every group has baruser, so it matches both chunks
+            qs = LdapGroup.objects.filter(usernames__in=['foouser', 'baruser', 'nobody'])
+            self.assertEquals(qs.count(), 3)
+            self.assertEquals([g.name for g in qs.order_by('name')],
+                              ['bargroup', 'foogroup', 'wizgroup'])
+            self.assertEquals([g.name for g in qs.order_by('-name')[1:2]], ['foogroup'])
+            self.assertEquals(len(qs[:2]), 2)
+        finally:
+            del connection.settings_dict['IN_CHUNK_SIZE']
+
+    def test_cached_values(self):
+        connection = connections[router.db_for_read(LdapGroup)]
+        connection.settings_dict['CACHE'] = {}
+        try:
+            g = LdapGroup.objects.get(name='foogroup')
+            g.usernames.append('zoouser')
+
+            # the cached search is not changed by the instance
+            g = LdapGroup.objects.get(name='foogroup')
+            self.assertEquals(g.usernames, ['foouser', 'baruser'])
+            self.assertTrue(connection.get_search_cache().stats()['hits'] > 0)
+        finally:
+            connection.get_search_cache().clear()
+            del connection.settings_dict['CACHE']
+
     def test_update(self):
         g = LdapGroup.objects.get(name='foogroup')
 
@@ -332,6 +615,28 @@ class UserTestCase(BaseTestCase):
         u.save()
         self.assertEquals(u.dn, 'uid=foouser2,%s' % LdapUser.base_dn)
 
+    def test_deferred(self):
+        u = LdapUser.objects.only('first_name').get(username='foouser')
+        self.assertEquals(u.dn, 'uid=foouser,%s' % LdapUser.base_dn)
+        self.assertFalse('photo' in u.__dict__)
+        self.assertEquals(u.first_name, u'Fôo')
+
+        # all the deferred fields are loaded together
+        self.assertEquals(u.uid, 2000)
+        self.assertTrue('photo' in u.__dict__)
+        self.assertTrue('last_name' in u.__dict__)
+
+        u = LdapUser.objects.defer('photo').get(username='foouser')
+        self.assertFalse('photo' in u.__dict__)
+        u.first_name = u'Fôo2'
+        u.save()
+        u = LdapUser.objects.get(username='foouser')
+        self.assertEquals(u.first_name, u'Fôo2')
+        self.assertTrue(u.photo.startswith('\xff\xd8'))
+
+        self.assertEquals(list(LdapUser.objects.values_list('dn', flat=True)),
+                          ['uid=foouser,%s' % LdapUser.base_dn])
+
 class ScopedTestCase(BaseTestCase):
     def setUp(self):
         super(ScopedTestCase, self).setUp()
@@ -32,13 +32,35 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import collections
 import django
 import ldap
-from ldap.controls import SimplePagedResultsControl
-from django.conf import settings
+import ldap.dn
+import ldap.ldapobject
+import logging
+import select
+from ldap.cidict import cidict
+from ldap.controls import LDAPControl, SimplePagedResultsControl
 from django.db.backends import BaseDatabaseFeatures, BaseDatabaseOperations, BaseDatabaseWrapper
 from django.db.backends.creation import BaseDatabaseCreation
 
+try:
+    from ldap.controls.readentry import PreReadControl, PostReadControl
+except ImportError:
+    # read entry controls require pyasn1 and pyasn1_modules
+    PreReadControl = None
+    PostReadControl = None
+
+from ldapdb.backends.ldap.cache import get_cache
+from ldapdb.backends.ldap.mirror import get_mirror
+from ldapdb.backends.ldap.pool import CONNECTION_ERRORS, connect, get_pool
+from ldapdb.backends.ldap.replicas import REPLICA_ERRORS, get_replica_set
+
+logger = logging.getLogger(__name__)
+
+# Tree Delete control (draft-armijo-ldap-treedelete)
+TREE_DELETE_OID = '1.2.840.113556.1.4.805'
+
 class DatabaseCreation(BaseDatabaseCreation):
     def create_test_db(self, verbosity=1, autoclobber=False, serialize=True):
         """
@@ -54,6 +76,96 @@ class DatabaseCreation(BaseDatabaseCreation):
         """
         pass
 
+class AsyncSearch(object):
+    """
+    A search running on the server, identified by its message id.
+
+    poll() never blocks, so many searches can be kept in flight and driven
+    by a single event loop, using fileno() to wait for incoming data.
+    """
+    def __init__(self, connection, msgid, charset, on_done=None, on_error=None):
+        self.connection = connection
+        self.msgid = msgid
+        self.charset = charset
+        self.done = False
+        self._on_done = on_done
+        self._on_error = on_error
+
+    def fileno(self):
+        return self.connection.get_option(ldap.OPT_DESC)
+
+    def poll(self):
+        """
+        Returns the (dn, attrs) tuples received since the last call without
+        waiting for the server. Once the search is complete, done is True.
+        """
+        output = []
+        while not self.done:
+            try:
+                rtype, rdata, rmsgid, resp_ctrls = self.connection.result3(
+                    self.msgid, all=0, timeout=0)
+            except ldap.LDAPError as e:
+                self._finish()
+                if self._on_error is not None:
+                    self._on_error(e)
+                raise
+            if rtype is None:
+                # nothing more received yet
+                break
+            for dn, attrs in rdata:
+                if dn:
+                    output.append((dn.decode(self.charset), attrs))
+            if rtype == ldap.RES_SEARCH_RESULT:
+                self._finish()
+        return output
+
+    def abandon(self):
+        if not self.done:
+            self.connection.abandon(self.msgid)
+            self._finish()
+
+    def _finish(self):
+        self.done = True
+        if self._on_done is not None:
+            self._on_done()
+
+class AsyncWrite(object):
+    """
+    A write operation running on the server, identified by its message id.
+
+    Like AsyncSearch.poll(), poll() never blocks. on_done is called with
+    the error of the operation, or None, once it is complete.
+    """
+    def __init__(self, connection, msgid, on_done=None):
+        self.connection = connection
+        self.msgid = msgid
+        self.done = False
+        self._on_done = on_done
+
+    def fileno(self):
+        return self.connection.get_option(ldap.OPT_DESC)
+
+    def poll(self):
+        """
+        Returns True once the operation is complete, and raises its error
+        if it failed.
+        """
+        if not self.done:
+            try:
+                rtype, rdata, rmsgid, resp_ctrls = self.connection.result3(
+                    self.msgid, all=1, timeout=0)
+            except ldap.LDAPError as e:
+                self._finish(e)
+                raise
+            if rtype is not None:
+                self._finish(None)
+        return self.done
+
+    def _finish(self, error):
+        self.done = True
+        if self._on_done is not None:
+            self._on_done(error)
+
 class DatabaseCursor(object):
     def __init__(self, ldap_connection):
         self.connection = ldap_connection
@@ -81,121 +193,748 @@ class DatabaseWrapper(BaseDatabaseWrapper):
         else:
             self.ops = DatabaseOperations()
         self.settings_dict['SUPPORTS_TRANSACTIONS'] = False
+        self._supported_controls = None
+        self._read_connections = {}
+        # set once the main connection has lost the server
+        self._connection_lost = False
 
     def close(self):
         if hasattr(self, 'validate_thread_sharing'):
             # django >= 1.4
             self.validate_thread_sharing()
         if self.connection is not None:
-            self.connection.unbind_s()
+            self._release(self.settings_dict['NAME'], self.connection,
+                          discard=self._connection_lost)
             self.connection = None
+            self._connection_lost = False
+        for uri, connection in self._read_connections.items():
+            self._release(uri, connection)
+        self._read_connections = {}
 
     def _commit(self):
         pass
 
+    def _get_pool(self, uri):
+        """
+        Returns the connection pool for the given server, or None if pooling
+        is not enabled in the settings.
+        """
+        options = self.settings_dict.get('POOL')
+        if not isinstance(options, dict):
+            return None
+        return get_pool(uri,
+                        self.settings_dict['USER'],
+                        self.settings_dict['PASSWORD'],
+                        options)
+
+    def get_search_cache(self):
+        """
+        Returns the search cache, or None unless CACHE is configured.
+        """
+        options = self.settings_dict.get('CACHE')
+        if not isinstance(options, dict):
+            return None
+        return get_cache(self.alias, options)
+
+    def get_mirror(self, base):
+        """
+        Returns the local mirror of the given subtree, which is started on
+        first use.
+        """
+        return get_mirror(self.settings_dict['NAME'],
+                          self.settings_dict['USER'],
+                          self.settings_dict['PASSWORD'],
+                          base, charset=self.charset)
+
+    def _invalidate(self, *dns):
+        cache = self.get_search_cache()
+        if cache is not None:
+            for dn in dns:
+                cache.invalidate(dn)
+
+    def _get_replicas(self):
+        """
+        Returns the set of read replicas, or None if READ_URIS is not set,
+        in which case all operations go to the server in NAME.
+        """
+        uris = self.settings_dict.get('READ_URIS')
+        if not uris:
+            return None
+        return get_replica_set(uris,
+                               strategy=self.settings_dict.get('READ_STRATEGY', 'round-robin'),
+                               retry=self.settings_dict.get('REPLICA_RETRY', 30))
+
+    def _open(self, uri):
+        pool = self._get_pool(uri)
+        if pool is not None:
+            return pool.acquire()
+        return connect(uri, self.settings_dict['USER'], self.settings_dict['PASSWORD'])
+
+    def _release(self, uri, connection, discard=False):
+        pool = self._get_pool(uri)
+        if pool is not None:
+            if discard:
+                pool.discard(connection)
+            else:
+                pool.release(connection)
+        else:
+            try:
+                connection.unbind_s()
+            except ldap.LDAPError:
+                if not discard:
+                    raise
+
     def _cursor(self):
+        if self._connection_lost:
+            self._release(self.settings_dict['NAME'], self.connection, discard=True)
+            self.connection = None
+            self._connection_lost = False
         if self.connection is None:
-            #self.connection = ldap.initialize(self.settings_dict['NAME'])
-            self.connection = ldap.ldapobject.ReconnectLDAPObject(
-                    uri=self.settings_dict['NAME'],
-                    trace_level=0,
-                    )
+            self.connection = self._open(self.settings_dict['NAME'])
 
-            self.connection.simple_bind_s(
-                self.settings_dict['USER'],
-                self.settings_dict['PASSWORD'])
+        return DatabaseCursor(self.connection)
 
-            # Allow custom options to ldap. Active directory should set
-            # ldap.OPT_REFERRALS as 0, or it not work.
-            ldap_options = getattr(settings,'LDAPDB_LDAP_OPTIONS',{})
-            for opt_name,opt_value in ldap_options.items():
-                    self.connection.set_option(opt_name,opt_value)
+    def _read_cursor(self):
+        """
+        Returns a cursor on one of the read replicas along with its URI, or
+        a cursor on the main server and None if no replica is available.
+        """
+        replicas = self._get_replicas()
+        while replicas is not None:
+            uri = replicas.choose()
+            if uri is None:
+                logger.warning("No read replica available, using %s" % self.settings_dict['NAME'])
+                break
+            connection = self._read_connections.get(uri)
+            if connection is None:
+                try:
+                    connection = self._open(uri)
+                except REPLICA_ERRORS as e:
+                    logger.warning("Ejecting read replica %s: %s" % (uri, e))
+                    replicas.eject(uri)
+                    continue
+                self._read_connections[uri] = connection
+            return DatabaseCursor(connection), uri
+        return self._cursor(), None
 
-            #self.connection.set_option(ldap.OPT_TIMEOUT,1)
-            #self.connection.set_option(ldap.OPT_TIMELIMIT,1)
+    def _connection_failed(self, connection, error):
+        """
+        Notes that the main connection lost the server, in which case it is
+        closed instead of going back to the pool.
+        """
+        if connection is self.connection and isinstance(error, CONNECTION_ERRORS):
+            self._connection_lost = True
 
-        return DatabaseCursor(self.connection)
+    def _replica_failed(self, uri, error):
+        logger.warning("Ejecting read replica %s: %s" % (uri, error))
+        connection = self._read_connections.pop(uri, None)
+        if connection is not None:
+            self._release(uri, connection, discard=True)
+        self._get_replicas().eject(uri)
 
     def _rollback(self):
         pass
 
-    def _paged_search(self, connection, base, scope, filterstr, attrlist):
+    def _paged_search(self, connection, base, scope, filterstr, attrlist, serverctrls=None,
+                      sizelimit=0):
         page_size = self.settings_dict.get('PAGE_SIZE', 1000)
-        results = []
+        if sizelimit:
+            page_size = min(page_size, sizelimit)
         pg_ctrl = SimplePagedResultsControl(True, page_size, "")
-        scope = ldap.SCOPE_SUBTREE
-        pages = 0
+        req_ctrls = [pg_ctrl] + (serverctrls or [])
+        count = 0
+        cookie = None
 
-        while True:
-            pages += 1
-            msgid = connection.search_ext(
-                base,
-                scope=scope,
-                filterstr=filterstr,
-                attrlist=attrlist,
-                serverctrls=[pg_ctrl]
-            )
-            rtype, rdata, rmsgid, serverctrls = connection.result3(msgid)
-            results.extend(rdata)
-            cookie = serverctrls[0].cookie
-            if cookie:
-                pg_ctrl.cookie = cookie
-                search = connection.search_ext(
+        try:
+            while True:
+                # only one page is requested at a time, the next one is
+                # asked for once this one has been received. Cookies are
+                # lost with the connection, so only the first page can be
+                # sent again after reconnecting
+                msgid = self._search_ext(
+                    connection,
                     base,
+                    retry=not pg_ctrl.cookie,
                     scope=scope,
                     filterstr=filterstr,
                     attrlist=attrlist,
-                    serverctrls=[pg_ctrl]
+                    serverctrls=req_ctrls
                 )
-            else:
-                break
+                cookie = None
+                rtype, rdata, rmsgid, resp_ctrls = connection.result3(msgid)
+                for ctrl in resp_ctrls:
+                    if ctrl.controlType == SimplePagedResultsControl.controlType:
+                        cookie = ctrl.cookie
+                # hand out the page before requesting the next one, so that at
+                # most one page is held in memory at a time
+                for entry in rdata[:sizelimit - count if sizelimit else None]:
+                    yield entry
+                count += len(rdata)
+                if not cookie or (sizelimit and count >= sizelimit):
+                    break
+                pg_ctrl.cookie = cookie
+        finally:
+            if cookie:
+                # the remaining pages are not needed, a request with a page
+                # size of 0 lets the server release the search
+                pg_ctrl.size = 0
+                pg_ctrl.cookie = cookie
+                try:
+                    connection.result3(connection.search_ext(
+                        base,
+                        scope=scope,
+                        filterstr=filterstr,
+                        attrlist=attrlist,
+                        serverctrls=req_ctrls
+                    ))
+                except ldap.LDAPError:
+                    pass
 
-        return results
+    def _search_ext(self, connection, base, retry=True, **kwargs):
+        """
+        Sends a search. ReconnectLDAPObject only reconnects the synchronous
+        methods, so if retry is True and the server went away, the
+        connection is reopened and the search sent once more.
+        """
+        try:
+            return connection.search_ext(base, **kwargs)
+        except ldap.SERVER_DOWN:
+            if not retry or not isinstance(connection, ldap.ldapobject.ReconnectLDAPObject):
+                raise
+            connection.reconnect(connection._uri)
+            return connection.search_ext(base, **kwargs)
 
-    def bind_s(self, dn, password):
+    def _search(self, connection, base, scope, filterstr, attrlist, serverctrls=None,
+                sizelimit=0):
+        msgid = self._search_ext(
+            connection,
+            base,
+            scope=scope,
+            filterstr=filterstr,
+            attrlist=attrlist,
+            serverctrls=serverctrls,
+            sizelimit=sizelimit,
+        )
+        pending = True
+        try:
+            while pending:
+                # fetch entries one by one as they arrive from the server
+                try:
+                    rtype, rdata, rmsgid, resp_ctrls = connection.result3(msgid, all=0)
+                except ldap.SIZELIMIT_EXCEEDED:
+                    pending = False
+                    if not sizelimit:
+                        raise
+                    # all the entries we asked for have been received
+                    break
+                except ldap.LDAPError:
+                    pending = False
+                    raise
+                pending = (rtype != ldap.RES_SEARCH_RESULT)
+                for entry in rdata:
+                    yield entry
+        finally:
+            if pending:
+                # the caller stopped reading results, don't let the server
+                # send the remaining entries
+                connection.abandon(msgid)
+
+    def supports_control(self, oid):
+        """
+        Returns True if the server advertises the given control OID in its
+        root DSE. The list of supported controls is only fetched once.
+        """
+        if self._supported_controls is None:
+            cursor = self._cursor()
+            try:
+                results = cursor.connection.search_s('', ldap.SCOPE_BASE,
+                    '(objectClass=*)', ['supportedControl'])
+                attrs = cidict(results[0][1])
+                self._supported_controls = set(attrs.get('supportedControl', []))
+            except (ldap.LDAPError, IndexError) as e:
+                self._connection_failed(cursor.connection, e)
+                self._supported_controls = set()
+        return oid in self._supported_controls
+
+    def _send(self, connection, request):
+        op, dn, args = request[0], request[1].encode(self.charset), request[2:]
+        if op == 'add':
+            return connection.add_ext(dn, *args)
+        elif op == 'modify':
+            return connection.modify_ext(dn, *args)
+        elif op == 'delete':
+            return connection.delete_ext(dn, *args)
+        raise ValueError("Unsupported pipelined operation: %s" % op)
+
+    def pipeline(self, requests, window=None):
+        """
+        Sends write operations without waiting for the result of each one,
+        keeping at most 'window' of them outstanding (PIPELINE_WINDOW from
+        the settings by default).
+
+        Each request is a tuple of the operation name, the DN and the other
+        arguments of the operation:
+
+            ('add', dn, modlist[, serverctrls])
+            ('modify', dn, modlist[, serverctrls])
+            ('delete', dn[, serverctrls])
+
+        Yields (request, error) tuples in the order the requests were given,
+        where error is the LDAPError raised by the operation, or None.
+        """
+        window = window or self.settings_dict.get('PIPELINE_WINDOW', 64)
         cursor = self._cursor()
-        return cursor.connection.bind_s(dn.encode(self.charset),
-                                        password,
-                                        ldap.AUTH_SIMPLE)
+        requests = iter(requests)
+        pending = collections.deque()
+        exhausted = False
+        try:
+            while pending or not exhausted:
+                while not exhausted and len(pending) < window:
+                    try:
+                        request = next(requests)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    try:
+                        msgid = self._send(cursor.connection, request)
+                    except ldap.LDAPError as e:
+                        self._connection_failed(cursor.connection, e)
+                        raise
+                    pending.append((request, msgid))
 
-    def add_s(self, dn, modlist):
+                if pending:
+                    # the server may complete operations in any order, the
+                    # result of each one is read by its message id and
+                    # waiting for the oldest one keeps the output in order
+                    request, msgid = pending.popleft()
+                    try:
+                        cursor.connection.result3(msgid)
+                    except ldap.LDAPError as e:
+                        self._connection_failed(cursor.connection, e)
+                        error = e
+                    else:
+                        error = None
+                    self._invalidate(request[1])
+                    yield request, error
+        finally:
+            # the caller stopped early, make sure the operations which were
+            # sent are complete before the connection is used again
+            for request, msgid in pending:
+                try:
+                    cursor.connection.result3(msgid)
+                except ldap.LDAPError:
+                    pass
+                self._invalidate(request[1])
+
+    def delete_many(self, dns, subtree=False, window=None):
+        """
+        Deletes the given entries, pipelining the requests.
+
+        If subtree is True, entries which still have children are removed
+        along with their descendants: with the Tree Delete control when the
+        server supports it, otherwise deepest entries first.
+
+        Entries which no longer exist are ignored. The first other error is
+        raised once all the requests have completed.
+        """
+        serverctrls = []
+        if subtree and self.supports_control(TREE_DELETE_OID):
+            serverctrls = [LDAPControl(TREE_DELETE_OID, True)]
+
+        errors = []
+        nonleaf = []
+        requests = [('delete', dn, serverctrls) for dn in dns]
+        for request, error in self.pipeline(requests, window):
+            if subtree and isinstance(error, ldap.NOT_ALLOWED_ON_NONLEAF):
+                nonleaf.append(request[1])
+            elif error is not None and not isinstance(error, ldap.NO_SUCH_OBJECT):
+                errors.append(error)
+
+        for dn in nonleaf:
+            errors.extend(self._delete_subtree(dn, window))
+        if errors:
+            raise errors[0]
+
+    def _delete_subtree(self, dn, window=None):
+        # the children are listed on the main server without the search
+        # cache, a stale list would leave entries behind
         cursor = self._cursor()
-        return cursor.connection.add_s(dn.encode(self.charset), modlist)
+        if self.settings_dict.get('SUPPORTS_PAGINATION', False):
+            search = self._paged_search
+        else:
+            search = self._search
+        levels = {}
+        try:
+            for child, attrs in search(cursor.connection, dn.encode(self.charset),
+                                       ldap.SCOPE_SUBTREE, '(objectClass=*)', ['1.1']):
+                if child:
+                    depth = len(ldap.dn.explode_dn(child))
+                    levels.setdefault(depth, []).append(child.decode(self.charset))
+        except ldap.NO_SUCH_OBJECT:
+            return []
+        except ldap.LDAPError as e:
+            self._connection_failed(cursor.connection, e)
+            raise
+
+        # the server may process outstanding operations in any order, so a
+        # level has to be gone before its parents are deleted
+        errors = []
+        for depth in sorted(levels, reverse=True):
+            requests = [('delete', child) for child in levels[depth]]
+            for request, error in self.pipeline(requests, window):
+                if error is not None and not isinstance(error, ldap.NO_SUCH_OBJECT):
+                    errors.append(error)
+        return errors
 
-    def delete_s(self, dn):
+    def bind_s(self, dn, password):
+        """
+        Checks the password of an entry by binding as it, which raises
+        ldap.INVALID_CREDENTIALS if it is wrong.
+
+        The bind is made on a dedicated connection which is closed right
+        away, pooled and shared connections keep the configured identity.
+        """
+        connection = connect(self.settings_dict['NAME'], dn.encode(self.charset),
+                             password, cls=ldap.ldapobject.SimpleLDAPObject)
+        try:
+            connection.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def add_s(self, dn, modlist, serverctrls=None):
         cursor = self._cursor()
-        return cursor.connection.delete_s(dn.encode(self.charset))
+        try:
+            return cursor.connection.add_ext_s(dn.encode(self.charset), modlist,
+                                               serverctrls=serverctrls)
+        except ldap.LDAPError as e:
+            self._connection_failed(cursor.connection, e)
+            raise
+        finally:
+            self._invalidate(dn)
 
-    def modify_s(self, dn, modlist):
+    def delete_s(self, dn, serverctrls=None):
         cursor = self._cursor()
-        return cursor.connection.modify_s(dn.encode(self.charset), modlist)
+        try:
+            return cursor.connection.delete_ext_s(dn.encode(self.charset),
+                                                  serverctrls=serverctrls)
+        except ldap.LDAPError as e:
+            self._connection_failed(cursor.connection, e)
+            raise
+        finally:
+            self._invalidate(dn)
 
-    def rename_s(self, dn, newrdn, newsuperior=None, delold=1):
+    def modify_s(self, dn, modlist, serverctrls=None):
         cursor = self._cursor()
-        if newsuperior:
-            newsuperior = newsuperior.encode(self.charset)
-        return cursor.connection.rename_s(dn.encode(self.charset),
-                                          newrdn.encode(self.charset),
-                                          newsuperior=newsuperior,
-                                          delold=delold)
-
-    def search_s(self, base, scope, filterstr='(objectClass=*)',attrlist=None):
+        try:
+            return cursor.connection.modify_ext_s(dn.encode(self.charset), modlist,
+                                                  serverctrls=serverctrls)
+        except ldap.LDAPError as e:
+            self._connection_failed(cursor.connection, e)
+            raise
+        finally:
+            self._invalidate(dn)
+
+    def rename_s(self, dn, newrdn, newsuperior=None, delold=1, serverctrls=None):
         cursor = self._cursor()
+        try:
+            return cursor.connection.rename_s(dn.encode(self.charset),
+                                              newrdn.encode(self.charset),
+                                              newsuperior=newsuperior and newsuperior.encode(self.charset),
+                                              delold=delold,
+                                              serverctrls=serverctrls)
+        except ldap.LDAPError as e:
+            self._connection_failed(cursor.connection, e)
+            raise
+        finally:
+            # the entry and its children were moved to the new parent
+            parent = newsuperior or dn.split(',', 1)[-1]
+            self._invalidate(dn, "%s,%s" % (newrdn, parent))
+
+    def read_entry(self, dn, attrlist=None):
+        """
+        Reads an entry from the main server, bypassing the read replicas
+        and the search cache, so that the result of the last writes is
+        seen. Returns a (dn, attrs) tuple, or None if there is no such
+        entry.
+        """
+        cursor = self._cursor()
+        try:
+            results = cursor.connection.search_ext_s(
+                dn.encode(self.charset),
+                ldap.SCOPE_BASE,
+                filterstr='(objectClass=*)',
+                attrlist=attrlist,
+            )
+        except ldap.NO_SUCH_OBJECT:
+            return None
+        except ldap.LDAPError as e:
+            self._connection_failed(cursor.connection, e)
+            raise
+        for entry_dn, attrs in results:
+            if entry_dn:
+                return entry_dn.decode(self.charset), attrs
+        return None
+
+    def read_controls(self, pre_read=None, post_read=None):
+        """
+        Builds the RFC 4527 controls asking the server to return the given
+        attributes of an entry as they were before (pre_read) and after
+        (post_read) a write operation.
+
+        The controls which the server or python-ldap do not support are
+        left out, so callers must be ready to do without the entries.
+        """
+        ctrls = []
+        if PreReadControl is None:
+            return ctrls
+        if pre_read is not None and self.supports_control(ldap.CONTROL_PRE_READ):
+            ctrls.append(PreReadControl(False, pre_read))
+        if post_read is not None and self.supports_control(ldap.CONTROL_POST_READ):
+            ctrls.append(PostReadControl(False, post_read))
+        return ctrls
+
+    def read_entries(self, result):
+        """
+        Returns the entries sent back through the read entry controls of a
+        write operation result, as a (pre, post) tuple of (dn, attrs). The
+        entries which were not returned are None.
+        """
+        entries = {}
+        for ctrl in (result and result[3]) or []:
+            if ctrl.controlType in (ldap.CONTROL_PRE_READ, ldap.CONTROL_POST_READ) \
+               and ctrl.entry is not None:
+                entries[ctrl.controlType] = (ctrl.dn.decode(self.charset), ctrl.entry)
+        return (entries.get(ldap.CONTROL_PRE_READ),
+                entries.get(ldap.CONTROL_POST_READ))
+
+    def _results(self, base, scope, filterstr, attrlist, serverctrls=None, sizelimit=0):
         pagination = self.settings_dict.get('SUPPORTS_PAGINATION', False)
+        base = base.encode(self.charset)
         filterstr = filterstr.encode(self.charset)
-        results = []
-        
-        if pagination:
-            results = self._paged_search(cursor.connection, base, scope, filterstr, attrlist)
-        else:
-            results = cursor.connection.search_s(base, scope, filterstr, attrlist)
+
+        while True:
+            cursor, uri = self._read_cursor()
+            if pagination and scope != ldap.SCOPE_BASE:
+                results = self._paged_search(cursor.connection, base, scope, filterstr, attrlist,
+                                             serverctrls=serverctrls, sizelimit=sizelimit)
+            else:
+                results = self._search(cursor.connection, base, scope, filterstr, attrlist,
+                                       serverctrls=serverctrls, sizelimit=sizelimit)
+
+            if uri is None:
+                try:
+                    for entry in results:
+                        yield entry
+                except ldap.LDAPError as e:
+                    self._connection_failed(cursor.connection, e)
+                    raise
+                return
+
+            replicas = self._get_replicas()
+            replicas.begin(uri)
+            received = False
+            try:
+                for entry in results:
+                    received = True
+                    yield entry
+                return
+            except REPLICA_ERRORS as e:
+                self._replica_failed(uri, e)
+                # the search can only be retried on another replica if
+                # nothing was handed out yet
+                if received:
+                    raise
+            finally:
+                replicas.end(uri)
+
+    def count_s(self, base, scope, filterstr='(objectClass=*)', sizelimit=0):
+        """
+        Returns the number of entries matching a search. No attributes are
+        requested and entries are discarded as soon as they are counted.
+        """
+        count = 0
+        # '1.1' is the special attribute list meaning "no attributes"
+        for dn, attrs in self._results(base, scope, filterstr, ['1.1'], sizelimit=sizelimit):
+            if dn:
+                count += 1
+        return count
+
+    def search_iter(self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+                    serverctrls=None, sizelimit=0):
+        """
+        Performs a search and yields (dn, attrs) tuples as they are received
+        from the server, without holding the full result set in memory.
+
+        If sizelimit is set, at most that many entries are requested from
+        the server. Searches without controls go through the search cache
+        when CACHE is configured.
+        """
+        # controls can change the results and are not part of the key
+        cache = None if serverctrls else self.get_search_cache()
+        token = None
+        if cache is not None:
+            key = (base, scope, filterstr,
+                   attrlist and tuple(attrlist), sizelimit)
+            entries, token = cache.get(key)
+            if entries is not None:
+                for entry in entries:
+                    yield entry
+                return
+            entries = []
+
+        try:
+            results = self._results(base, scope, filterstr, attrlist,
+                                    serverctrls=serverctrls, sizelimit=sizelimit)
+            for dn, attrs in results:
+                # In tests, Active Directory always return last line as 
+                # (None, ['ldap://DomainDnsZones.mydomain.corp/DC=DomainDnsZones,DC=mydomain,DC=corp'])]
+                # so we check for DN and avoid errors on results.
+                if dn:
+                    entry = (dn.decode(self.charset), attrs)
+                    if token is not None:
+                        entries.append(entry)
+                    yield entry
+
+            # only complete result sets are cached
+            if token is not None:
+                cache.set(token, entries)
+        finally:
+            if token is not None:
+                cache.release(token)
+
+    def search_async(self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+                     serverctrls=None, sizelimit=0):
+        """
+        Sends a search to the server and returns an AsyncSearch to collect
+        its results without blocking.
+        """
+        cursor, uri = self._read_cursor()
+        on_done = None
+        on_error = lambda error: self._connection_failed(cursor.connection, error)
+        if uri is not None:
+            replicas = self._get_replicas()
+            replicas.begin(uri)
+            on_done = lambda: replicas.end(uri)
+
+            def on_error(error):
+                if isinstance(error, REPLICA_ERRORS):
+                    self._replica_failed(uri, error)
+        try:
+            msgid = cursor.connection.search_ext(
+                base.encode(self.charset),
+                scope=scope,
+                filterstr=filterstr.encode(self.charset),
+                attrlist=attrlist,
+                serverctrls=serverctrls,
+                sizelimit=sizelimit,
+            )
+        except Exception as e:
+            if on_done is not None:
+                on_done()
+            on_error(e)
+            raise
+        return AsyncSearch(cursor.connection, msgid, self.charset, on_done, on_error)
+
+    def write_async(self, request, on_done=None):
+        """
+        Sends a write operation, given as for pipeline(), and returns an
+        AsyncWrite to collect its result without blocking. on_done is
+        called with the error of the operation, or None.
+
+        A modification without changes is not sent, and is already done.
+        """
+        cursor = self._cursor()
+
+        def done(error):
+            self._connection_failed(cursor.connection, error)
+            self._invalidate(request[1])
+            if on_done is not None:
+                on_done(error)
+
+        if request[0] == 'modify' and not request[2]:
+            write = AsyncWrite(cursor.connection, None)
+            write.done = True
+            if on_done is not None:
+                on_done(None)
+            return write
+        try:
+            msgid = self._send(cursor.connection, request)
+        except ldap.LDAPError as e:
+            self._connection_failed(cursor.connection, e)
+            raise
+        return AsyncWrite(cursor.connection, msgid, done)
+
+    def search_many(self, base, scope, filterstrs, attrlist=None, window=None):
+        """
+        Runs one search per filter, keeping at most 'window' of them in
+        flight (PIPELINE_WINDOW from the settings by default), and yields
+        the (dn, attrs) tuples of all of them as they arrive. Entries
+        matched by several filters are only yielded once.
+        """
+        window = window or self.settings_dict.get('PIPELINE_WINDOW', 64)
+        filterstrs = iter(filterstrs)
+        running = []
+        seen = set()
+        exhausted = False
+        try:
+            while running or not exhausted:
+                while not exhausted and len(running) < window:
+                    try:
+                        filterstr = next(filterstrs)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    running.append(self.search_async(base, scope, filterstr, attrlist))
+
+                received = False
+                for search in running:
+                    for dn, attrs in search.poll():
+                        received = True
+                        if dn not in seen:
+                            seen.add(dn)
+                            yield dn, attrs
+                running = [search for search in running if not search.done]
+                if running and not received:
+                    select.select(set(search.fileno() for search in running), [], [], 1)
+        finally:
+            # the caller stopped reading results or a search failed
+            for search in running:
+                search.abandon()
+
+    def search_ctrls(self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+                     serverctrls=None):
+        """
+        Performs a single, non-paged search and returns a tuple of the
+        results and the controls sent back by the server.
+        """
+        while True:
+            cursor, uri = self._read_cursor()
+            if uri is not None:
+                self._get_replicas().begin(uri)
+            try:
+                msgid = cursor.connection.search_ext(
+                    base.encode(self.charset),
+                    scope=scope,
+                    filterstr=filterstr.encode(self.charset),
+                    attrlist=attrlist,
+                    serverctrls=serverctrls,
+                )
+                rtype, rdata, rmsgid, resp_ctrls = cursor.connection.result3(msgid)
+                break
+            except REPLICA_ERRORS as e:
+                if uri is None:
+                    self._connection_failed(cursor.connection, e)
+                    raise
+                self._replica_failed(uri, e)
+            finally:
+                if uri is not None:
+                    self._get_replicas().end(uri)
 
         output = []
-        for dn, attrs in results:
-            # In tests, Active Directory always return last line as 
-            # (None, ['ldap://DomainDnsZones.mydomain.corp/DC=DomainDnsZones,DC=mydomain,DC=corp'])]
-            # so we check for DN and avoid errors on results.
+        for dn, attrs in rdata:
             if dn:
                 output.append((dn.decode(self.charset), attrs))
-        return output
+        return output, resp_ctrls
 
+    def search_s(self, base, scope, filterstr='(objectClass=*)',attrlist=None, sizelimit=0):
+        return list(self.search_iter(base, scope, filterstr, attrlist, sizelimit=sizelimit))
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+# 
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# All rights reserved.
+# 
+# See AUTHORS file for a full list of contributors.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of Bolloré telecom nor the names of its contributors
+#        may be used to endorse or promote products derived from this software
+#        without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import collections
+import copy
+import cPickle as pickle
+import hashlib
+import os
+import re
+import threading
+import time
+import zlib
+
+try:
+    from django.core.cache import caches
+    get_django_cache = caches.__getitem__
+except ImportError:
+    # Django < 1.7
+    from django.core.cache import get_cache as get_django_cache
+
+# caches are shared by all the threads of a process
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(alias, options):
+    """
+    Returns the process-wide search cache of the given database, creating
+    it if needed.
+
+    The options are read from the CACHE entry of the database settings:
+
+        MAX_SIZE: maximum number of cached searches
+        TIMEOUT: seconds during which a cached search is used
+        CACHE_ALIAS: name of a Django cache in which the searches are
+                     stored, to share them between processes
+        LOCK_TIMEOUT: seconds during which other processes wait for the
+                      one running a search to store its results
+    """
+    key = (os.getpid(), alias)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            if options.get('CACHE_ALIAS'):
+                cache = SharedSearchCache(alias, options['CACHE_ALIAS'],
+                                          timeout=options.get('TIMEOUT', 60),
+                                          lock_timeout=options.get('LOCK_TIMEOUT', 10))
+            else:
+                cache = SearchCache(max_size=options.get('MAX_SIZE', 1000),
+                                    timeout=options.get('TIMEOUT', 60))
+            _caches[key] = cache
+    return cache
+
+
+def overlaps(base, dn):
+    """
+    Returns True if one of the DNs is the other or one of its ancestors.
+    """
+    base, dn = base.lower(), dn.lower()
+    return base == dn or base.endswith(',' + dn) or dn.endswith(',' + base)
+
+
+def ancestors(dn):
+    """
+    Returns the given DN followed by the DNs of its ancestors.
+    """
+    rdns = re.split(r'(?<!\\),', dn.lower())
+    return [','.join(rdns[i:]) for i in range(len(rdns))]
+
+
+class SearchCache(object):
+    """
+    A thread-safe LRU cache of search results with a time to live.
+
+    Keys start with the search base, which is used to invalidate the
+    searches affected by a write. Results are copied when stored and when
+    returned, as model instances keep and may modify the lists of values.
+    """
+    def __init__(self, max_size=1000, timeout=60):
+        self.max_size = max_size
+        self.timeout = timeout
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # incremented by each invalidation, so that searches which were
+        # running at the time are not stored
+        self.generation = 0
+
+        self._lock = threading.Lock()
+        # key -> (expiry time, results), least recently used first
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        Returns a (results, token) tuple. On a miss results is None and the
+        token is passed to set() once the search is done.
+        """
+        with self._lock:
+            token = (key, self.generation)
+            item = self._entries.pop(key, None)
+            if item is None or item[0] < time.time():
+                self.misses += 1
+                return None, token
+            self._entries[key] = item
+            self.hits += 1
+        return copy.deepcopy(item[1]), token
+
+    def set(self, token, results):
+        """
+        Stores results, unless an invalidation happened since the token
+        was obtained.
+        """
+        key, generation = token
+        results = copy.deepcopy(results)
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.timeout, results)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, dn):
+        """
+        Drops the searches whose base overlaps the given DN.
+        """
+        with self._lock:
+            self.generation += 1
+            for key in [key for key in self._entries if overlaps(key[0], dn)]:
+                del self._entries[key]
+
+    def release(self, token):
+        pass
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns the counters of the cache as a dict.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+            }
+
+
+class SharedSearchCache(object):
+    """
+    Stores search results in a Django cache shared by several processes.
+
+    Cache keys include version numbers, which writes bump instead of
+    deleting entries: the subtree version of the written DN and of all its
+    ancestors, and the node version of the written DN. A search depends on
+    the subtree version of its base and the node versions of the base's
+    ancestors, which are affected when one of them is renamed or deleted.
+
+    On a miss, the first process takes a lock and runs the search while
+    the others wait for its results.
+    """
+    def __init__(self, alias, cache_alias, timeout=60, lock_timeout=10):
+        self.alias = alias
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+
+        # counters of this process
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    @property
+    def cache(self):
+        return get_django_cache(self.cache_alias)
+
+    def _key(self, kind, value):
+        digest = hashlib.md5(repr(value)).hexdigest()
+        return 'ldapdb:%s:%s:%s' % (self.alias, kind, digest)
+
+    def _new_version(self):
+        # versions which were evicted must not come back to a value used
+        # before, so they are seeded from the clock
+        return int(time.time() * 1000000)
+
+    def _versions(self, base):
+        cache = self.cache
+        dns = ancestors(base)
+        keys = [self._key('subtree', dns[0])] + \
+               [self._key('node', dn) for dn in dns[1:]]
+        versions = cache.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                cache.add(key, self._new_version(), None)
+                versions[key] = cache.get(key)
+        return [versions[key] for key in keys]
+
+    def get(self, key):
+        """
+        Returns a (results, token) tuple. On a miss results is None and the
+        token is passed to set() once the search is done, then to release().
+        """
+        cache = self.cache
+        data_key = self._key('search', (key, self._versions(key[0])))
+        lock_key = data_key + ':lock'
+
+        data = cache.get(data_key)
+        if data is None and not cache.add(lock_key, 1, self.lock_timeout):
+            # another process is running the search
+            self.waits += 1
+            deadline = time.time() + self.lock_timeout
+            while data is None and time.time() < deadline:
+                time.sleep(0.05)
+                data = cache.get(data_key)
+            lock_key = None
+
+        if data is None:
+            self.misses += 1
+            return None, (data_key, lock_key)
+        self.hits += 1
+        return pickle.loads(zlib.decompress(data)), (data_key, None)
+
+    def set(self, token, results):
+        data = zlib.compress(pickle.dumps(results, pickle.HIGHEST_PROTOCOL))
+        self.cache.set(token[0], data, self.timeout)
+
+    def release(self, token):
+        if token[1] is not None:
+            self.cache.delete(token[1])
+
+    def invalidate(self, dn):
+        """
+        Bumps the versions which searches overlapping the given DN use.
+        """
+        cache = self.cache
+        dns = ancestors(dn)
+        keys = [self._key('node', dns[0])] + \
+               [self._key('subtree', ancestor) for ancestor in dns]
+        for key in keys:
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, self._new_version(), None)
+
+    def stats(self):
+        """
+        Returns the counters of this process as a dict.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'waits': self.waits,
+        }
@@ -32,15 +32,70 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import heapq
+import itertools
 import ldap
+import ldap.dn
 import logging
 
+from django.core.exceptions import FieldError
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.sql import aggregates, compiler
 from django.db.models.sql.where import AND, OR
 
+from ldapdb.backends.ldap import filters
+from ldapdb.backends.ldap.mirror import in_scope
+from ldapdb.backends.ldap.sorting import external_sort
+
+try:
+    from ldap.controls.sss import SSSRequestControl
+    from ldap.controls.vlv import VLVRequestControl, VLVResponseControl
+except ImportError:
+    # server side sorting requires python-ldap >= 2.4.21 and pyasn1
+    SSSRequestControl = None
+    VLVRequestControl = None
+
 
 logger = logging.getLogger(__name__)
 
+# errors returned by the server when it is unable to sort the results
+SORT_ERRORS = (
+    ldap.UNAVAILABLE_CRITICAL_EXTENSION,
+    ldap.INAPPROPRIATE_MATCHING,
+    ldap.UNWILLING_TO_PERFORM,
+)
+
+# errors returned by the server when it is unable to provide a virtual list view
+VLV_ERRORS = SORT_ERRORS + (getattr(ldap, 'VLV_ERROR', ldap.OTHER),)
+
+
+class _Reversed(object):
+    """
+    Wraps a sort key component so that it sorts in descending order.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+    def __le__(self, other):
+        return other.value <= self.value
+
+    def __ge__(self, other):
+        return other.value >= self.value
+
 
 def get_lookup_operator(lookup_type):
     if lookup_type == 'gte':
@@ -54,28 +109,155 @@ def get_lookup_operator(lookup_type):
     else:
         return '='
 
+# filter templates, keyed on the object classes of the model, the shape of
+# the WHERE tree and the size of the chunks large OR terms are split into
+FILTER_CACHE_SIZE = 1000
+_filter_templates = {}
+
+SUBSTRING_LOOKUPS = ('startswith', 'istartswith', 'endswith', 'iendswith',
+                     'contains', 'icontains')
+
+
 def query_as_ldap(query):
+    """
+    Returns the filter of a query, or None if the query can't match any
+    entry.
+    """
+    filterstrs = query_filters(query)
+    if not filterstrs:
+        return
+    logger.debug(filterstrs[0])
+    return filterstrs[0]
+
+def query_filters(query, chunk_size=None):
+    """
+    Returns the filters whose union matches the entries of a query: a
+    single filter, unless chunk_size is set and the query has an OR term
+    with more children, for instance an __in lookup with a long list, in
+    which case that term is split. Returns an empty list if the query
+    can't match any entry.
+    """
     # starting with django 1.6 we can receive empty querysets
+    if hasattr(query, 'is_empty') and query.is_empty():
+        return []
+
+    shape, params = where_shape(query.where)
+    key = (tuple(query.model.object_classes), shape, chunk_size)
+    try:
+        templates = _filter_templates[key]
+    except KeyError:
+        classes = tuple(('=', 'objectClass', cls) for cls in query.model.object_classes)
+        node = filters.normalize(('&', classes + (shape,)))
+        if node == filters.FALSE:
+            templates = []
+        elif chunk_size:
+            templates = [filters.to_template(chunk) for chunk in filters.split(node, chunk_size)]
+        else:
+            templates = [filters.to_template(node)]
+        if len(_filter_templates) >= FILTER_CACHE_SIZE:
+            _filter_templates.clear()
+        _filter_templates[key] = templates
+
+    return [template % tuple(params[i] for i in order)
+            for template, order in templates]
+
+def query_target(query):
+    """
+    Returns the DN of the only entry a query can match, when it is an
+    exact lookup on the dn or on all the primary key fields, along with
+    the filter the entry must match. Returns None otherwise.
+    """
     if hasattr(query, 'is_empty') and query.is_empty():
         return
 
-    filterstr = ''.join(['(objectClass=%s)' % cls for cls in
-                         query.model.object_classes])
-    sql, params = where_as_ldap(query.where)
-    filterstr += sql
-    logger.debug(filterstr)
+    shape, params = where_shape(query.where)
+    key = (query.model, shape, 'target')
+    try:
+        target = _filter_templates[key]
+    except KeyError:
+        target = _target_template(query.model, shape)
+        if len(_filter_templates) >= FILTER_CACHE_SIZE:
+            _filter_templates.clear()
+        _filter_templates[key] = target
+
+    if target is None:
+        return
+    dn_param, rdn, (template, order) = target
+    if dn_param is not None:
+        # the dn field is not escaped for filters
+        dn = params[dn_param]
+    else:
+        rdn = '+'.join('%s=%s' % (column, ldap.dn.escape_dn_chars(
+                                  filters.unescape(unicode(params[i]))))
+                       for column, i in rdn)
+        dn = '%s,%s' % (rdn, query.model.base_dn)
+    return dn, template % tuple(params[i] for i in order)
+
+def _target_template(model, shape):
+    classes = tuple(('=', 'objectClass', cls) for cls in model.object_classes)
+    node = filters.normalize(('&', classes + (shape,)))
+    if node == filters.FALSE:
+        return None
+
+    terms = node[1] if node[0] == '&' else (node,)
+    equal = {}
+    for term in terms:
+        if term[0] == '=' and isinstance(term[2], filters.Param):
+            equal.setdefault(term[1], []).append(term[2])
+
+    dn_param = None
+    rdn = []
+    if len(equal.get('dn', [])) == 1:
+        # dn is not an attribute, the term is replaced by the base read
+        dn_param = equal['dn'][0]
+        terms = tuple(term for term in terms if term[1:] != ('dn', dn_param))
+    else:
+        for field in model._meta.fields:
+            if field.db_column and field.primary_key:
+                if len(equal.get(field.db_column, [])) != 1:
+                    return None
+                rdn.append((field.db_column, equal[field.db_column][0]))
+        if not rdn:
+            return None
 
-    return '(&%s)' % filterstr
+    node = filters.normalize(('&', terms))
+    if node == filters.TRUE:
+        return dn_param, rdn, ('(objectClass=*)', [])
+    return dn_param, rdn, filters.to_template(node)
 
 def where_as_ldap(self):
-    bits = []
+    shape, params = where_shape(self)
+    node = filters.normalize(shape)
+    if node == filters.TRUE:
+        return '', []
+    template, order = filters.to_template(node)
+    return template % tuple(params[i] for i in order), []
+
+def where_shape(self, params=None, indexes=None):
+    """
+    Returns the shape of a WHERE tree, which is its filter tree with Param
+    placeholders instead of the values, and the list of values.
+
+    Equal terms share the same placeholder, so that they are deduplicated
+    when the tree is normalized.
+    """
+    if params is None:
+        params, indexes = [], {}
+
+    def param(op, column, value):
+        key = (op, column, value)
+        if key not in indexes:
+            indexes[key] = filters.Param(len(params))
+            params.append(value)
+        return indexes[key]
+
+    children = []
     for item in self.children:
         if hasattr(item, 'lhs') and hasattr(item, 'rhs'):
             # Django 1.7
             item = item.lhs.target.column, item.lookup_name, None, item.rhs
         elif hasattr(item, 'as_sql'):
-            sql, params = where_as_ldap(item)
-            bits.append(sql)
+            children.append(where_shape(item, params, indexes)[0])
             continue
 
         constraint, lookup_type, y, values = item
@@ -83,32 +265,29 @@ def where_as_ldap(self):
             constraint = constraint.col
         comp = get_lookup_operator(lookup_type)
         if lookup_type == 'in':
-            equal_bits = [ "(%s%s%s)" % (constraint, comp, value) for value in values ]
-            clause = '(|%s)' % ''.join(equal_bits)
-        elif lookup_type == 'isnull' and not values:
-            clause = '(!(%s%s%s))' % (constraint, comp, '*')
-            #self.negated = True
+            # an empty list is the absolute false filter
+            term = ('|', tuple(('=', constraint, param('=', constraint, value))
+                               for value in values))
+        elif lookup_type == 'isnull':
+            term = ('present', constraint)
+            if not values:
+                term = ('!', term)
+        elif lookup_type in SUBSTRING_LOOKUPS:
+            term = ('substr', constraint, param('substr', constraint, values))
         else:
-            clause = "(%s%s%s)" % (constraint, comp, values)
-
-        bits.append(clause)
+            term = (comp, constraint, param(comp, constraint, values))
+        children.append(term)
 
-    if not len(bits):
-        return '', []
-
-    if len(bits) == 1:
-        sql_string = bits[0]
-    elif self.connector == AND:
-        sql_string = '(&%s)' % ''.join(bits)
+    if self.connector == AND:
+        node = ('&', tuple(children))
     elif self.connector == OR:
-        sql_string = '(|%s)' % ''.join(bits)
+        node = ('|', tuple(children))
     else:
         raise Exception("Unhandled WHERE connector: %s" % self.connector)
 
     if self.negated:
-        sql_string = ('(!%s)' % sql_string)
-
-    return sql_string, []
+        node = ('!', node)
+    return node, params
 
 class SQLCompiler(compiler.SQLCompiler):
     def __init__(self, query, connection, using):
@@ -129,16 +308,11 @@ class SQLCompiler(compiler.SQLCompiler):
             return
 
         try:
-            vals = self.connection.search_s(
-                self.query.model.base_dn,
-                self.query.model.search_scope,
-                filterstr=filterstr,
-                attrlist=['dn'],
-            )
+            count = self.count_search(filterstr)
         except ldap.NO_SUCH_OBJECT:
-            vals = []
+            count = 0
 
-        if not vals:
+        if not count:
             return None
 
         output = []
@@ -146,88 +320,442 @@ class SQLCompiler(compiler.SQLCompiler):
             output.append(col[0])
         for key, aggregate in self.query.aggregate_select.items():
             if isinstance(aggregate, aggregates.Count):
-                output.append(len(vals))
+                output.append(count)
             else:
                 output.append(None)
         return output
 
-    def results_iter(self):
-        filterstr = query_as_ldap(self.query)
-        if not filterstr:
-            return
+    def count_search(self, filterstr):
+        """
+        Returns the number of entries matching the query, up to the upper
+        bound of the slice if there is one.
+        """
+        high_mark = self.query.high_mark
+        vals = self.mirror_search(filterstr)
+        if vals is None:
+            vals = self.base_search(['1.1'])
+        if vals is not None:
+            return min(len(vals), high_mark or len(vals))
+
+        vals = self.chunked_search(['1.1'])
+        if vals is not None:
+            return sum(1 for entry in itertools.islice(vals, high_mark))
+
+        if high_mark is None:
+            count = self.vlv_count(filterstr)
+            if count is not None:
+                return count
+
+        return self.connection.count_s(
+            self.query.model.base_dn,
+            self.query.model.search_scope,
+            filterstr=filterstr,
+            sizelimit=high_mark or 0,
+        )
+
+    def mirror_search(self, filterstr):
+        """
+        Returns the matching entries from the local mirror of the model's
+        subtree, or None if the model is not mirrored or the mirror is not
+        in sync.
+        """
+        model = self.query.model
+        if not model.mirrored:
+            return None
+        return self.connection.get_mirror(model.base_dn).search(
+            model.base_dn, model.search_scope, filterstr)
+
+    def base_search(self, attrlist):
+        """
+        Returns the matching entries by reading a single entry, when the
+        query is an exact lookup on the dn or on all the primary key fields,
+        or None otherwise.
+
+        Entries are read directly below the base DN of the model, so if
+        nothing is found there and the model searches its whole subtree,
+        None is returned and a regular search has to be made.
+        """
+        model = self.query.model
+        target = query_target(self.query)
+        if target is None:
+            return None
+        dn, filterstr = target
+        if not in_scope(dn.lower(), model.base_dn.lower(), model.search_scope):
+            return None
 
-        if hasattr(self.query, 'select_fields') and len(self.query.select_fields):
-            # django < 1.6
-            fields = self.query.select_fields
-        elif len(self.query.select):
-            # django >= 1.6
-            fields = [x.field for x in self.query.select]
-        else:
-            fields = self.query.model._meta.fields
+        try:
+            vals = list(self.connection.search_iter(
+                dn,
+                ldap.SCOPE_BASE,
+                filterstr=filterstr,
+                attrlist=attrlist,
+            ))
+        except ldap.NO_SUCH_OBJECT:
+            vals = []
+        if not vals and model.search_scope == ldap.SCOPE_SUBTREE:
+            return None
+        return vals
+
+    def chunked_search(self, attrlist, base=None):
+        """
+        Returns the matching entries, found by concurrent searches of
+        IN_CHUNK_SIZE values each of the largest __in lookup, or None if
+        IN_CHUNK_SIZE is not set or the filter does not need to be split.
+
+        The entries are not sorted, and are only returned once even if they
+        match several chunks. Chunks are not paged, so IN_CHUNK_SIZE must
+        be small enough for each chunk to stay below the size limit of the
+        server.
+        """
+        chunk_size = self.connection.settings_dict.get('IN_CHUNK_SIZE')
+        if not chunk_size:
+            return None
+        filterstrs = query_filters(self.query, chunk_size)
+        if len(filterstrs) < 2:
+            return None
+        return self.connection.search_many(
+            base or self.query.model.base_dn,
+            self.query.model.search_scope,
+            filterstrs,
+            attrlist=attrlist,
+        )
+
+    def matching_dns(self, filterstr):
+        """
+        Returns the DNs of the matching entries.
+        """
+        base = self.query.model.get_base_dn(self.using)
+        vals = self.base_search(['1.1'])
+        if vals is None:
+            vals = self.chunked_search(['1.1'], base)
+        if vals is None:
+            vals = self.connection.search_iter(
+                base,
+                self.query.model.search_scope,
+                filterstr=filterstr,
+                attrlist=['1.1'],
+            )
+        return [dn for dn, attrs in vals]
+
+    def vlv_count(self, filterstr):
+        """
+        Returns the number of matching entries as reported by the server in
+        a virtual list view response, or None if it is not available.
+
+        This is only used if USE_VLV_COUNT is enabled for the connection, as
+        some servers only return an estimate.
+        """
+        if not self.connection.settings_dict.get('USE_VLV_COUNT', False) or \
+           VLVRequestControl is None or \
+           not self.connection.supports_control(SSSRequestControl.controlType) or \
+           not self.connection.supports_control(VLVRequestControl.controlType):
+            return None
 
-        attrlist = [x.db_column for x in fields if x.db_column]
+        # a virtual list view requires sorting, use the primary key
+        rules = self.get_sort_rules(['pk'])
+        if not rules:
+            return None
 
+        vlv_ctrl = VLVRequestControl(
+            criticality=True,
+            before_count=0,
+            after_count=0,
+            offset=1,
+            content_count=0,
+        )
         try:
-            vals = self.connection.search_s(
+            vals, resp_ctrls = self.connection.search_ctrls(
                 self.query.model.base_dn,
                 self.query.model.search_scope,
                 filterstr=filterstr,
-                attrlist=attrlist,
+                attrlist=['1.1'],
+                serverctrls=[SSSRequestControl(criticality=True, ordering_rules=rules),
+                             vlv_ctrl],
             )
-        except ldap.NO_SUCH_OBJECT:
-            return
+        except VLV_ERRORS as e:
+            logger.debug("Virtual list view failed, counting client side: %s" % e)
+            return None
 
-        # perform sorting
+        for ctrl in resp_ctrls:
+            if ctrl.controlType == VLVResponseControl.controlType and not ctrl.result:
+                return ctrl.content_count
+        return None
+
+    def get_ordering(self):
         if self.query.extra_order_by:
-            ordering = self.query.extra_order_by
+            return self.query.extra_order_by
         elif not self.query.default_ordering:
-            ordering = self.query.order_by
+            return self.query.order_by
         else:
-            ordering = self.query.order_by or self.query.model._meta.ordering
-        def cmpvals(x, y):
-            for fieldname in ordering:
-                if fieldname.startswith('-'):
-                    fieldname = fieldname[1:]
-                    negate = True
-                else:
-                    negate = False
-                if fieldname == 'pk':
-                    fieldname = self.query.model._meta.pk.name
+            return self.query.order_by or self.query.model._meta.ordering
+
+    def get_sort_rules(self, ordering):
+        """
+        Returns the server side sort rules for the given ordering, or None
+        if one of the fields can't be sorted by the server.
+        """
+        rules = []
+        for fieldname in ordering:
+            if fieldname.startswith('-'):
+                fieldname = fieldname[1:]
+                prefix = '-'
+            else:
+                prefix = ''
+            if fieldname == 'pk':
+                fieldname = self.query.model._meta.pk.name
 
+            try:
                 field = self.query.model._meta.get_field(fieldname)
-                attr_x = field.from_ldap(x[1].get(field.db_column, []), connection=self.connection)
-                attr_y = field.from_ldap(y[1].get(field.db_column, []), connection=self.connection)
-                # perform case insensitive comparison
-                if hasattr(attr_x, 'lower'):
-                    attr_x = attr_x.lower()
-                if hasattr(attr_y, 'lower'):
-                    attr_y = attr_y.lower()
-                val = negate and cmp(attr_y, attr_x) or cmp(attr_x, attr_y)
-                if val:
-                    return val
-            return 0
-        vals = sorted(vals, cmp=cmpvals)
-
-        # process results
-        pos = 0
-        for dn, attrs in vals:
-            # FIXME : This is not optimal, we retrieve more results than we need
-            # but there is probably no other options as we can't perform ordering
-            # server side.
-            if (self.query.low_mark and pos < self.query.low_mark) or \
-               (self.query.high_mark is not None and pos >= self.query.high_mark):
-                pos += 1
+            except FieldDoesNotExist:
+                return None
+            rule = getattr(field, 'ordering_rule', None)
+            if not field.db_column or not rule:
+                return None
+            rules.append('%s%s:%s' % (prefix, field.db_column, rule))
+        return rules
+
+    def get_sort_key(self, ordering):
+        """
+        Returns a function computing the key by which (dn, attrs) tuples are
+        sorted client side. Strings are compared case insensitively.
+        """
+        fields = []
+        for fieldname in ordering:
+            if fieldname.startswith('-'):
+                fieldname = fieldname[1:]
+                negate = True
+            else:
+                negate = False
+            if fieldname == 'pk':
+                fieldname = self.query.model._meta.pk.name
+            fields.append((self.query.model._meta.get_field(fieldname), negate))
+
+        def sort_key(entry):
+            key = []
+            for field, negate in fields:
+                value = field.from_ldap(entry[1].get(field.db_column, []),
+                                        connection=self.connection)
+                if hasattr(value, 'lower'):
+                    value = value.lower()
+                key.append(_Reversed(value) if negate else value)
+            return key
+        return sort_key
+
+    def sort_entries(self, vals, ordering, high_mark=None):
+        """
+        Sorts (dn, attrs) tuples client side. When only the first high_mark
+        entries are needed, they are selected with a bounded heap instead of
+        sorting all of them.
+
+        If SORT_RUN_SIZE is set, larger result sets are sorted on disk, by
+        runs of that many entries.
+        """
+        key = self.get_sort_key(ordering)
+        if high_mark is not None:
+            return heapq.nsmallest(high_mark, vals, key=key)
+        run_size = self.connection.settings_dict.get('SORT_RUN_SIZE')
+        if run_size:
+            return external_sort(vals, key, run_size)
+        return sorted(vals, key=key)
+
+    def sorted_search(self, filterstr, attrlist, ordering, sizelimit=0):
+        """
+        Performs a search whose results are sorted by the server, or returns
+        None if the server is unable to sort on the given ordering.
+        """
+        if SSSRequestControl is None or \
+           not self.connection.supports_control(SSSRequestControl.controlType):
+            return None
+
+        rules = self.get_sort_rules(ordering)
+        if not rules:
+            return None
+
+        vals = self.connection.search_iter(
+            self.query.model.base_dn,
+            self.query.model.search_scope,
+            filterstr=filterstr,
+            attrlist=attrlist,
+            serverctrls=[SSSRequestControl(criticality=True, ordering_rules=rules)],
+            sizelimit=sizelimit,
+        )
+
+        # sorting errors are reported before any entry is sent
+        try:
+            first = next(vals)
+        except StopIteration:
+            return []
+        except SORT_ERRORS as e:
+            logger.debug("Server side sorting failed, sorting client side: %s" % e)
+            return None
+        return itertools.chain([first], vals)
+
+    def vlv_search(self, filterstr, attrlist, ordering):
+        """
+        Performs a search returning only the requested slice of the sorted
+        results using a virtual list view, or returns None if the server is
+        unable to provide one.
+        """
+        low_mark, high_mark = self.query.low_mark, self.query.high_mark
+        if high_mark is not None and high_mark <= low_mark:
+            # an empty slice, which the view can't express
+            return []
+        if high_mark is None or VLVRequestControl is None or \
+           not self.connection.supports_control(SSSRequestControl.controlType) or \
+           not self.connection.supports_control(VLVRequestControl.controlType):
+            return None
+
+        rules = self.get_sort_rules(ordering)
+        if not rules:
+            return None
+
+        # offsets in the list are 1-based, a content count of 0 tells the
+        # server to interpret the offset as an absolute position
+        vlv_ctrl = VLVRequestControl(
+            criticality=True,
+            before_count=0,
+            after_count=high_mark - low_mark - 1,
+            offset=low_mark + 1,
+            content_count=0,
+        )
+        try:
+            vals, resp_ctrls = self.connection.search_ctrls(
+                self.query.model.base_dn,
+                self.query.model.search_scope,
+                filterstr=filterstr,
+                attrlist=attrlist,
+                serverctrls=[SSSRequestControl(criticality=True, ordering_rules=rules),
+                             vlv_ctrl],
+            )
+        except VLV_ERRORS as e:
+            logger.debug("Virtual list view failed, slicing client side: %s" % e)
+            return None
+
+        for ctrl in resp_ctrls:
+            if ctrl.controlType != VLVResponseControl.controlType:
                 continue
-            row = []
-            for field in iter(fields):
-                if field.attname == 'dn':
-                    row.append(dn)
-                elif hasattr(field, 'from_ldap'):
-                    row.append(field.from_ldap(attrs.get(field.db_column, []), connection=self.connection))
+            if ctrl.result:
+                logger.debug("Virtual list view failed, slicing client side: %s" % ctrl.result)
+                return None
+            # when the offset is past the end of the list, the server
+            # positions the view on the last entry
+            if ctrl.target_position < low_mark + 1:
+                return []
+        return vals
+
+    def get_fields(self):
+        """
+        Returns the fields loaded by the query, in the order of the rows.
+        """
+        if hasattr(self.query, 'select_fields') and len(self.query.select_fields):
+            # django < 1.6
+            fields = self.query.select_fields
+        elif len(self.query.select):
+            # django >= 1.6
+            fields = [x.field for x in self.query.select]
+        else:
+            fields = self.query.model._meta.fields
+            # only() and defer()
+            only_load = self.query.get_loaded_field_names()
+            loaded = only_load.get(self.query.model)
+            if loaded is not None:
+                fields = [x for x in fields if x.name in loaded]
+        return fields
+
+    def get_attrlist(self, fields):
+        # '1.1' is the special attribute list meaning "no attributes", an
+        # empty list would request all of them
+        return [x.db_column for x in fields if x.db_column] or ['1.1']
+
+    def entry_row(self, dn, attrs, fields):
+        """
+        Converts a (dn, attrs) tuple to a row of values of the fields.
+        """
+        row = []
+        for field in iter(fields):
+            if field.attname == 'dn':
+                row.append(dn)
+            elif hasattr(field, 'from_ldap'):
+                row.append(field.from_ldap(attrs.get(field.db_column, []), connection=self.connection))
+            else:
+                row.append(None)
+        return row
+
+    def search_async(self, attrlist, sizelimit=0):
+        """
+        Sends the search of the query without waiting for the results, and
+        returns an AsyncSearch, or None if the query can't match any entry.
+        The fast paths of results_iter() are not used.
+        """
+        filterstr = query_as_ldap(self.query)
+        if not filterstr:
+            return None
+        return self.connection.search_async(
+            self.query.model.base_dn,
+            self.query.model.search_scope,
+            filterstr=filterstr,
+            attrlist=attrlist,
+            sizelimit=sizelimit,
+        )
+
+    def results_iter(self):
+        filterstr = query_as_ldap(self.query)
+        if not filterstr:
+            return
+
+        fields = self.get_fields()
+        attrlist = self.get_attrlist(fields)
+
+        # perform sorting
+        ordering = self.get_ordering()
+
+        try:
+            low_mark, high_mark = self.query.low_mark, self.query.high_mark
+            vals = self.mirror_search(filterstr)
+            if vals is None:
+                vals = self.base_search(attrlist)
+            if vals is None:
+                vals = self.chunked_search(attrlist)
+            if vals is not None:
+                if ordering:
+                    vals = self.sort_entries(vals, ordering, high_mark)
+            elif ordering:
+                vals = self.vlv_search(filterstr, attrlist, ordering)
+                if vals is not None:
+                    # the server already returned the requested slice
+                    low_mark, high_mark = 0, None
                 else:
-                    row.append(None)
-            yield row
-            pos += 1
+                    vals = self.sorted_search(filterstr, attrlist, ordering,
+                                              sizelimit=high_mark or 0)
+
+            if vals is None:
+                # sorting client side needs the whole result set, otherwise
+                # we only ask for the entries up to the end of the slice and
+                # stream them as they arrive
+                vals = self.connection.search_iter(
+                    self.query.model.base_dn,
+                    self.query.model.search_scope,
+                    filterstr=filterstr,
+                    attrlist=attrlist,
+                    sizelimit=0 if ordering else (high_mark or 0),
+                )
+                if ordering:
+                    vals = self.sort_entries(vals, ordering, high_mark)
+
+            # process results
+            pos = 0
+            for dn, attrs in vals:
+                # skip entries outside of the requested slice, unless the
+                # server already applied it using a virtual list view
+                if high_mark is not None and pos >= high_mark:
+                    break
+                if low_mark and pos < low_mark:
+                    pos += 1
+                    continue
+                yield self.entry_row(dn, attrs, fields)
+                pos += 1
+        except ldap.NO_SUCH_OBJECT:
+            return
 
 
 class SQLInsertCompiler(compiler.SQLInsertCompiler, SQLCompiler):
@@ -240,21 +768,57 @@ class SQLDeleteCompiler(compiler.SQLDeleteCompiler, SQLCompiler):
             return
 
         try:
-            vals = self.connection.search_s(
-                self.query.model.get_base_dn(self.using),
-                self.query.model.search_scope,
-                filterstr=filterstr,
-                attrlist=['dn'],
-            )
+            dns = self.matching_dns(filterstr)
         except ldap.NO_SUCH_OBJECT:
             return
 
-        # FIXME : there is probably a more efficient way to do this
-        for dn, attrs in vals:
-            self.connection.delete_s(dn)
+        self.connection.delete_many(dns,
+            subtree=self.connection.settings_dict.get('TREE_DELETE', False))
 
 class SQLUpdateCompiler(compiler.SQLUpdateCompiler, SQLCompiler):
-    pass
+    def as_modlist(self):
+        """
+        Builds the modlist which is applied to every matching entry.
+        """
+        modlist = []
+        for field, model, value in self.query.values:
+            if field.primary_key or field.name == 'dn':
+                # the entry would have to be renamed
+                raise FieldError("Cannot update the primary key field '%s' "
+                                 "with update(), use save() instead." % field.name)
+            if hasattr(value, 'evaluate'):
+                raise FieldError("Expressions are not supported by the LDAP backend.")
+            if value or isinstance(value, bool):
+                modlist.append((ldap.MOD_REPLACE, field.db_column,
+                                field.get_db_prep_save(value, connection=self.connection)))
+            else:
+                # replacing with no values removes the attribute, and
+                # unlike MOD_DELETE does not fail if it is already absent
+                modlist.append((ldap.MOD_REPLACE, field.db_column, None))
+        return modlist
+
+    def execute_sql(self, result_type=compiler.MULTI):
+        modlist = self.as_modlist()
+        filterstr = query_as_ldap(self.query)
+        if not modlist or not filterstr:
+            return 0
+
+        try:
+            dns = self.matching_dns(filterstr)
+        except ldap.NO_SUCH_OBJECT:
+            return 0
+
+        count = 0
+        errors = []
+        requests = [('modify', dn, modlist) for dn in dns]
+        for request, error in self.connection.pipeline(requests):
+            if error is None:
+                count += 1
+            elif not isinstance(error, ldap.NO_SUCH_OBJECT):
+                errors.append(error)
+        if errors:
+            raise errors[0]
+        return count
 
 class SQLAggregateCompiler(compiler.SQLAggregateCompiler, SQLCompiler):
     pass
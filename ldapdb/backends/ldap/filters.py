@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+# 
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# All rights reserved.
+# 
+# See AUTHORS file for a full list of contributors.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of Bolloré telecom nor the names of its contributors
+#        may be used to endorse or promote products derived from this software
+#        without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Parsing, normalization and local evaluation of LDAP search filters
+(RFC 4515).
+
+Filters are represented as nested tuples:
+
+    ('&', (child, ...))         ('|', (child, ...))       ('!', child)
+    ('=', attr, value)          ('>=', attr, value)       ('<=', attr, value)
+    ('~=', attr, value)         ('present', attr)         ('substr', attr, parts)
+
+where the parts of a substring filter are the pieces between the '*'
+wildcards, the first and last ones being empty when the value starts or
+ends with a wildcard. The empty AND and OR filters are the absolute true
+and false filters (RFC 4526).
+
+The compiler builds filter templates, in which values are Param
+placeholders standing for already escaped values.
+"""
+
+import re
+
+from ldapdb import escape_ldap_filter
+
+TRUE = ('&', ())
+FALSE = ('|', ())
+
+# terms are ordered so that the cheapest to evaluate come first
+_RANKS = {'=': 0, 'present': 1, '>=': 1, '<=': 1, '~=': 1, 'substr': 2}
+
+
+class Param(int):
+    """
+    Placeholder for the value at the given index in a filter template.
+    """
+    def __repr__(self):
+        return 'Param(%d)' % self
+
+_ITEM_RE = re.compile(r'^([^=<>~()*\\]+)(>=|<=|~=|=)(.*)$', re.DOTALL)
+_ESCAPE_RE = re.compile(r'\\([0-9a-fA-F]{2})')
+_INTEGER_RE = re.compile(r'^-?\d+$')
+
+
+def unescape(value):
+    """
+    Replaces the \\XX escapes of a filter value by the characters they
+    stand for.
+    """
+    value = _ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 16)),
+                           value.encode('utf-8'))
+    return value.decode('utf-8', 'replace')
+
+
+def parse(filterstr):
+    """
+    Parses a filter string into a tree of tuples. Raises ValueError if the
+    filter is invalid or uses extensible matching, which is not supported.
+    """
+    if isinstance(filterstr, str):
+        filterstr = filterstr.decode('utf-8')
+    try:
+        node, pos = _parse(filterstr, 0)
+    except IndexError:
+        raise ValueError("Invalid filter %r" % filterstr)
+    if pos != len(filterstr):
+        raise ValueError("Invalid filter %r" % filterstr)
+    return node
+
+
+def _parse(s, pos):
+    if s[pos] != '(':
+        raise ValueError("Invalid filter %r" % s)
+    pos += 1
+    if s[pos] in '&|':
+        op = s[pos]
+        pos += 1
+        children = []
+        while s[pos] == '(':
+            child, pos = _parse(s, pos)
+            children.append(child)
+        node = (op, tuple(children))
+    elif s[pos] == '!':
+        child, pos = _parse(s, pos + 1)
+        node = ('!', child)
+    else:
+        # parentheses are always escaped in values
+        end = s.index(')', pos)
+        node = _parse_item(s[pos:end])
+        pos = end
+    if s[pos] != ')':
+        raise ValueError("Invalid filter %r" % s)
+    return node, pos + 1
+
+
+def _parse_item(text):
+    m = _ITEM_RE.match(text)
+    if m is None or ':' in m.group(1):
+        raise ValueError("Unsupported filter item %r" % text)
+    attr, op, value = m.groups()
+    if op == '=' and value == '*':
+        return ('present', attr)
+    if op == '=' and '*' in value:
+        return ('substr', attr, tuple(unescape(part) for part in value.split('*')))
+    return (op, attr, unescape(value))
+
+
+def normalize(node):
+    """
+    Simplifies a filter: nested AND and OR filters are flattened, duplicate
+    terms removed, constant branches folded and double negations dropped.
+    Equality terms are moved before the other terms, and substring terms
+    after them.
+    """
+    op = node[0]
+    if op == '!':
+        child = normalize(node[1])
+        if child == TRUE:
+            return FALSE
+        elif child == FALSE:
+            return TRUE
+        elif child[0] == '!':
+            return child[1]
+        return ('!', child)
+    elif op not in ('&', '|'):
+        return node
+
+    absorbing = FALSE if op == '&' else TRUE
+    children = []
+    seen = set()
+    for child in node[1]:
+        child = normalize(child)
+        if child == absorbing:
+            return absorbing
+        # this also drops the neutral constant, which has no children
+        for term in (child[1] if child[0] == op else (child,)):
+            if term not in seen:
+                seen.add(term)
+                children.append(term)
+    if len(children) == 1:
+        return children[0]
+    children.sort(key=lambda term: _RANKS.get(term[0], 3))
+    return (op, tuple(children))
+
+
+def split(node, size):
+    """
+    Splits a normalized filter into filters whose union matches the same
+    entries, so that no OR term has more than size children. Only the
+    largest OR term of the top level AND, or the filter itself, is split.
+    """
+    if node[0] == '|':
+        if len(node[1]) <= size:
+            return [node]
+        chunks = [node[1][i:i + size] for i in range(0, len(node[1]), size)]
+        return [('|', chunk) if len(chunk) > 1 else chunk[0] for chunk in chunks]
+    elif node[0] != '&':
+        return [node]
+
+    terms = [term for term in node[1] if term[0] == '|']
+    if not terms:
+        return [node]
+    term = max(terms, key=lambda term: len(term[1]))
+    if len(term[1]) <= size:
+        return [node]
+    pos = node[1].index(term)
+    return [('&', node[1][:pos] + (chunk,) + node[1][pos + 1:])
+            for chunk in split(term, size)]
+
+
+def to_template(node):
+    """
+    Serializes a filter which may contain Param placeholders. Returns the
+    filter, with '%' doubled and %s in place of the placeholders, and the
+    list of the placeholders in order.
+    """
+    params = []
+    return _serialize(node, params), params
+
+
+def to_string(node):
+    """
+    Serializes a filter without placeholders.
+    """
+    template, params = to_template(node)
+    return template % ()
+
+
+def _serialize(node, params):
+    def value(v):
+        if isinstance(v, Param):
+            params.append(v)
+            return '%s'
+        return escape_ldap_filter(v).replace('%', '%%')
+
+    op = node[0]
+    if op in ('&', '|'):
+        return '(%s%s)' % (op, ''.join(_serialize(child, params) for child in node[1]))
+    elif op == '!':
+        return '(!%s)' % _serialize(node[1], params)
+
+    attr = node[1].replace('%', '%%')
+    if op == 'present':
+        return '(%s=*)' % attr
+    elif op == 'substr' and not isinstance(node[2], Param):
+        return '(%s=%s)' % (attr, '*'.join(value(part) for part in node[2]))
+    elif op == 'substr':
+        return '(%s=%s)' % (attr, value(node[2]))
+    return '(%s%s%s)' % (attr, op, value(node[2]))
+
+
+def index_entry(attrs, charset='utf-8'):
+    """
+    Prepares the attributes of an entry for match(): names and values are
+    lower-cased, values are decoded.
+    """
+    index = {}
+    for attr, values in attrs.items():
+        index.setdefault(attr.lower(), []).extend(
+            value.decode(charset, 'replace').lower() for value in values)
+    return index
+
+
+def _compare(x, y):
+    if _INTEGER_RE.match(x) and _INTEGER_RE.match(y):
+        return cmp(int(x), int(y))
+    return cmp(x, y)
+
+
+def _match_substr(value, parts):
+    initial, final = parts[0], parts[-1]
+    if not value.startswith(initial):
+        return False
+    pos = len(initial)
+    for part in parts[1:-1]:
+        pos = value.find(part, pos)
+        if pos < 0:
+            return False
+        pos += len(part)
+    return len(value) - pos >= len(final) and value.endswith(final)
+
+
+def match(node, index):
+    """
+    Returns True if the entry, prepared with index_entry(), matches the
+    filter.
+
+    Values are compared ignoring case, and as integers when both sides
+    are integers, which approximates the matching rules of the usual
+    attribute types but not of all of them.
+    """
+    op = node[0]
+    if op == '&':
+        return all(match(child, index) for child in node[1])
+    elif op == '|':
+        return any(match(child, index) for child in node[1])
+    elif op == '!':
+        return not match(node[1], index)
+
+    values = index.get(node[1].lower(), ())
+    if op == 'present':
+        return bool(values)
+    elif op == 'substr':
+        parts = tuple(part.lower() for part in node[2])
+        return any(_match_substr(value, parts) for value in values)
+
+    expected = node[2].lower()
+    if op == '>=':
+        return any(_compare(value, expected) >= 0 for value in values)
+    elif op == '<=':
+        return any(_compare(value, expected) <= 0 for value in values)
+    return any(_compare(value, expected) == 0 for value in values)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+# 
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# All rights reserved.
+# 
+# See AUTHORS file for a full list of contributors.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of Bolloré telecom nor the names of its contributors
+#        may be used to endorse or promote products derived from this software
+#        without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import logging
+import os
+import threading
+import time
+
+import ldap
+import ldap.ldapobject
+
+try:
+    from ldap.controls.psearch import PersistentSearchControl
+    from ldap.syncrepl import SyncreplConsumer
+except ImportError:
+    # syncrepl and persistent searches require pyasn1
+    PersistentSearchControl = None
+    SyncreplConsumer = object
+
+from ldapdb.backends.ldap import filters
+from ldapdb.backends.ldap.cache import ancestors
+from ldapdb.backends.ldap.pool import connect
+
+logger = logging.getLogger(__name__)
+
+SYNCREPL_OID = '1.3.6.1.4.1.4203.1.9.1.1'
+PSEARCH_OID = '2.16.840.1.113730.3.4.3'
+ECNC_OID = '2.16.840.1.113730.3.4.7'
+
+# change types of the entry change notification control
+CHANGE_DELETE = 2
+CHANGE_MODDN = 8
+
+# mirrors are shared by all the threads of a process
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_mirror(uri, user, password, base, charset='utf-8'):
+    """
+    Returns the process-wide mirror of the given subtree, starting it if
+    needed.
+    """
+    key = (os.getpid(), uri, base.lower())
+    with _mirrors_lock:
+        mirror = _mirrors.get(key)
+        if mirror is None:
+            mirror = Mirror(uri, user, password, base, charset=charset)
+            mirror.start()
+            _mirrors[key] = mirror
+    return mirror
+
+
+def in_scope(dn, base, scope):
+    """
+    Returns True if the DN is within the scope of a search of base. Both
+    DNs must be lower-cased.
+    """
+    if scope == ldap.SCOPE_BASE:
+        return dn == base
+    elif scope == ldap.SCOPE_ONELEVEL:
+        dns = ancestors(dn)
+        return len(dns) > 1 and dns[1] == base
+    return dn == base or dn.endswith(',' + base)
+
+
+class SyncreplConnection(ldap.ldapobject.ReconnectLDAPObject, SyncreplConsumer):
+    """
+    A connection which applies the changes received through syncrepl to
+    a mirror.
+    """
+    mirror = None
+
+    def syncrepl_get_cookie(self):
+        return self.mirror.cookie
+
+    def syncrepl_set_cookie(self, cookie):
+        self.mirror.cookie = cookie
+
+    def syncrepl_entry(self, dn, attrs, uuid):
+        self.mirror.store(uuid, dn, attrs)
+
+    def syncrepl_delete(self, uuids):
+        for uuid in uuids:
+            self.mirror.remove(uuid)
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        self.mirror.present(uuids, refreshDeletes)
+
+    def syncrepl_refreshdone(self):
+        self.mirror.ready = True
+
+
+class Mirror(object):
+    """
+    An in-memory copy of a subtree, kept up to date by a background thread
+    with a syncrepl (RFC 4533) refreshAndPersist search, or a persistent
+    search when the server does not support syncrepl.
+
+    Changes are applied asynchronously: a process does not necessarily
+    see its own writes immediately.
+    """
+    def __init__(self, uri, user, password, base, charset='utf-8', retry=5):
+        self.uri = uri
+        self.user = user
+        self.password = password
+        self.base = base
+        self.charset = charset
+        self.retry = retry
+
+        # set once the mirror holds the whole subtree and is kept in sync
+        self.ready = False
+        # set when the server can't keep a mirror in sync, queries then
+        # always go to the directory
+        self.unavailable = False
+        self.cookie = None
+
+        self._lock = threading.Lock()
+        # entryUUID (or DN) -> (dn, attrs, index)
+        self._entries = {}
+        # entries listed by the server during a syncrepl refresh
+        self._present = set()
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='ldapdb-mirror %s' % self.base)
+        thread.daemon = True
+        thread.start()
+
+    def search(self, base, scope, filterstr):
+        """
+        Returns the (dn, attrs) tuples matching the search, or None if the
+        mirror is not in sync or cannot evaluate the filter. The attributes
+        are copies, which callers may modify.
+        """
+        if not self.ready:
+            return None
+        try:
+            node = filters.parse(filterstr)
+        except ValueError:
+            return None
+
+        base = base.lower()
+        with self._lock:
+            entries = self._entries.values()
+        return [(dn, dict((attr, list(values)) for attr, values in attrs.items()))
+                for dn, attrs, index in entries
+                if in_scope(dn.lower(), base, scope) and filters.match(node, index)]
+
+    def store(self, key, dn, attrs):
+        dn = dn.decode(self.charset)
+        with self._lock:
+            self._entries[key] = (dn, attrs, filters.index_entry(attrs, self.charset))
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def present(self, keys, deletes=False):
+        with self._lock:
+            if keys is not None:
+                self._present.update(keys)
+                return
+            if not deletes:
+                # the entries which were not listed were deleted
+                for key in set(self._entries) - self._present:
+                    del self._entries[key]
+            self._present = set()
+
+    def _run(self):
+        while True:
+            try:
+                self._sync()
+            except ldap.UNAVAILABLE_CRITICAL_EXTENSION as e:
+                logger.warning("Mirror of %s stopped, the server can't keep it in sync: %s" % (
+                               self.base, e))
+                self.ready = False
+                self.unavailable = True
+                return
+            except Exception as e:
+                logger.warning("Mirror of %s interrupted: %s" % (self.base, e))
+            self.ready = False
+            time.sleep(self.retry)
+
+    def _sync(self):
+        connection = connect(self.uri, self.user, self.password, cls=SyncreplConnection)
+        connection.mirror = self
+        try:
+            controls = connection.search_s('', ldap.SCOPE_BASE, '(objectClass=*)',
+                                           ['supportedControl'])[0][1]
+            controls = controls.get('supportedControl', [])
+            if SyncreplConsumer is not object and SYNCREPL_OID in controls:
+                msgid = connection.syncrepl_search(
+                    self.base.encode(self.charset), ldap.SCOPE_SUBTREE,
+                    mode='refreshAndPersist', filterstr='(objectClass=*)',
+                    attrlist=['*', '+'])
+                while connection.syncrepl_poll(msgid=msgid, all=1):
+                    pass
+            elif PersistentSearchControl is not None and PSEARCH_OID in controls:
+                self._persistent_search(connection)
+            else:
+                raise ldap.UNAVAILABLE_CRITICAL_EXTENSION(
+                    {'desc': 'neither syncrepl nor persistent search is supported'})
+        finally:
+            connection.unbind_s()
+
+    def _persistent_search(self, connection):
+        base = self.base.encode(self.charset)
+        # start listening for changes before loading the subtree, changes
+        # received during the load are applied after it
+        ctrl = PersistentSearchControl(criticality=True, changesOnly=True, returnECs=True)
+        msgid = connection.search_ext(base, ldap.SCOPE_SUBTREE, '(objectClass=*)',
+                                      ['*', '+'], serverctrls=[ctrl])
+
+        with self._lock:
+            self._entries = {}
+        for dn, attrs in connection.search_s(base, ldap.SCOPE_SUBTREE, '(objectClass=*)',
+                                             ['*', '+']):
+            if dn:
+                self.store(dn.lower(), dn, attrs)
+        self.ready = True
+
+        while True:
+            rtype, rdata, rmsgid, rctrls, rname, rvalue = connection.result4(
+                msgid, all=0, timeout=-1, add_ctrls=1)
+            if rtype == ldap.RES_SEARCH_RESULT:
+                # the server ended the search
+                return
+            for dn, attrs, ctrls in rdata or []:
+                change = None
+                for ctrl in ctrls:
+                    if ctrl.controlType == ECNC_OID:
+                        change = ctrl
+                if change is not None and change.changeType == CHANGE_DELETE:
+                    self.remove(dn.lower())
+                    continue
+                if change is not None and change.changeType == CHANGE_MODDN:
+                    self.remove(change.previousDN.lower())
+                self.store(dn.lower(), dn, attrs)
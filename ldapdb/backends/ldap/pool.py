@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# 
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# All rights reserved.
+# 
+# See AUTHORS file for a full list of contributors.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of Bolloré telecom nor the names of its contributors
+#        may be used to endorse or promote products derived from this software
+#        without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import logging
+import os
+import threading
+import time
+
+import ldap
+import ldap.ldapobject
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# pools are shared by all the threads of a process
+_pools = {}
+_pools_lock = threading.Lock()
+
+# errors after which a connection can no longer be used
+CONNECTION_ERRORS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR)
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection could be checked out of a pool in time.
+    """
+    pass
+
+
+def connect(uri, user, password, cls=ldap.ldapobject.ReconnectLDAPObject):
+    """
+    Opens a new connection to the given server and binds it.
+    """
+    connection = cls(
+        uri=uri,
+        trace_level=0,
+    )
+
+    connection.simple_bind_s(user, password)
+
+    # Allow custom options to ldap. Active directory should set
+    # ldap.OPT_REFERRALS as 0, or it not work.
+    ldap_options = getattr(settings, 'LDAPDB_LDAP_OPTIONS', {})
+    for opt_name, opt_value in ldap_options.items():
+        connection.set_option(opt_name, opt_value)
+
+    #connection.set_option(ldap.OPT_TIMEOUT,1)
+    #connection.set_option(ldap.OPT_TIMELIMIT,1)
+
+    return connection
+
+
+def get_pool(uri, user, password, options):
+    """
+    Returns the process-wide pool of connections for the given server and
+    credentials, creating it if needed.
+
+    The options are read from the POOL entry of the database settings:
+
+        MIN_SIZE: number of connections opened with the pool, idle
+                  connections are not recycled below that number
+        MAX_SIZE: maximum number of open connections
+        TIMEOUT: seconds to wait for a connection when the pool is full
+        MAX_IDLE: seconds after which an idle connection is closed
+        CHECK_INTERVAL: seconds after which an idle connection is checked
+                        before being handed out
+    """
+    # connections must not be shared with forked processes
+    key = (os.getpid(), uri, user)
+    created = False
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(uri, user, password,
+                min_size=options.get('MIN_SIZE', 0),
+                max_size=options.get('MAX_SIZE', 10),
+                timeout=options.get('TIMEOUT', 30),
+                max_idle=options.get('MAX_IDLE', 300),
+                check_interval=options.get('CHECK_INTERVAL', 60))
+            _pools[key] = pool
+            created = True
+    if created:
+        # connect outside of the lock, other pools stay available meanwhile
+        pool.fill()
+    return pool
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of bound LDAP connections.
+    """
+    def __init__(self, uri, user, password, min_size=0, max_size=10, timeout=30,
+                 max_idle=300, check_interval=60):
+        self.uri = uri
+        self.user = user
+        self.password = password
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+
+        self._cond = threading.Condition()
+        # idle connections and the time they were released, oldest first
+        self._idle = []
+        # number of open connections, idle or checked out
+        self._size = 0
+
+    def acquire(self):
+        """
+        Checks out a connection, opening a new one if none is idle and the
+        pool is not full.
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            connection, last_used = self._checkout(deadline)
+            if connection is None:
+                try:
+                    return connect(self.uri, self.user, self.password)
+                except:
+                    self._forget()
+                    raise
+
+            if time.time() - last_used < self.check_interval or \
+               self._is_alive(connection):
+                return connection
+
+            logger.debug("Discarding dead connection to %s" % self.uri)
+            self.discard(connection)
+
+    def fill(self):
+        """
+        Opens connections until the pool holds at least min_size of them.
+        Failures are only logged, acquire() will try again.
+        """
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                connection = connect(self.uri, self.user, self.password)
+            except ldap.LDAPError as e:
+                self._forget()
+                logger.warning("Could not open connection to %s: %s" % (self.uri, e))
+                return
+            self.release(connection)
+
+    def release(self, connection):
+        """
+        Returns a connection to the pool.
+        """
+        with self._cond:
+            self._idle.append((connection, time.time()))
+            self._cond.notify()
+
+    def discard(self, connection):
+        """
+        Closes a checked out connection instead of returning it to the pool.
+        """
+        self._forget()
+        self._close(connection)
+
+    def _checkout(self, deadline):
+        """
+        Returns an idle connection and the time it was released, or
+        (None, None) if the caller should open a new connection.
+        """
+        with self._cond:
+            while True:
+                self._recycle()
+                if self._idle:
+                    # reuse the most recently used connection, so that the
+                    # others can reach MAX_IDLE and be recycled
+                    return self._idle.pop()
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None, None
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout("No connection to %s available after %s seconds" % (
+                                      self.uri, self.timeout))
+                self._cond.wait(remaining)
+
+    def _recycle(self):
+        # must be called with the lock held
+        now = time.time()
+        while len(self._idle) > self.min_size and now - self._idle[0][1] > self.max_idle:
+            connection, last_used = self._idle.pop(0)
+            self._size -= 1
+            self._close(connection)
+
+    def _forget(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _close(self, connection):
+        try:
+            connection.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _is_alive(self, connection):
+        try:
+            connection.search_s('', ldap.SCOPE_BASE, '(objectClass=*)', ['1.1'])
+        except ldap.LDAPError:
+            return False
+        return True
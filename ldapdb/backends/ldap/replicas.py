@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# 
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# All rights reserved.
+# 
+# See AUTHORS file for a full list of contributors.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of Bolloré telecom nor the names of its contributors
+#        may be used to endorse or promote products derived from this software
+#        without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import threading
+import time
+
+import ldap
+
+# errors after which a replica is considered unhealthy
+REPLICA_ERRORS = (
+    ldap.SERVER_DOWN,
+    ldap.CONNECT_ERROR,
+    ldap.TIMEOUT,
+)
+
+# replica sets are shared by all the threads of a process
+_replica_sets = {}
+_replica_sets_lock = threading.Lock()
+
+
+def get_replica_set(uris, strategy='round-robin', retry=30):
+    """
+    Returns the process-wide replica set for the given server URIs,
+    creating it if needed.
+    """
+    key = (os.getpid(), tuple(uris))
+    with _replica_sets_lock:
+        replicas = _replica_sets.get(key)
+        if replicas is None:
+            replicas = ReplicaSet(uris, strategy=strategy, retry=retry)
+            _replica_sets[key] = replicas
+    return replicas
+
+
+class ReplicaSet(object):
+    """
+    Spreads searches across read-only replicas.
+
+    The strategy is either 'round-robin', or 'least-outstanding' which picks
+    the replica with the fewest searches in progress. A replica which fails
+    is ejected for 'retry' seconds.
+    """
+    def __init__(self, uris, strategy='round-robin', retry=30):
+        if strategy not in ('round-robin', 'least-outstanding'):
+            raise ValueError("Unknown replica strategy: %s" % strategy)
+        self.uris = list(uris)
+        self.strategy = strategy
+        self.retry = retry
+
+        self._lock = threading.Lock()
+        self._next = 0
+        self._outstanding = dict((uri, 0) for uri in self.uris)
+        self._ejected = {}
+
+    def choose(self):
+        """
+        Returns the URI of the replica to use for the next search, or None
+        if all the replicas are ejected.
+        """
+        now = time.time()
+        with self._lock:
+            uris = [uri for uri in self.uris if self._ejected.get(uri, 0) <= now]
+            if not uris:
+                return None
+            if self.strategy == 'least-outstanding':
+                # rotate the candidates so that ties are spread evenly
+                start = self._next % len(uris)
+                uris = uris[start:] + uris[:start]
+                self._next += 1
+                return min(uris, key=lambda uri: self._outstanding[uri])
+            uri = uris[self._next % len(uris)]
+            self._next += 1
+            return uri
+
+    def begin(self, uri):
+        with self._lock:
+            self._outstanding[uri] += 1
+
+    def end(self, uri):
+        with self._lock:
+            self._outstanding[uri] -= 1
+
+    def eject(self, uri):
+        """
+        Stops using the given replica for 'retry' seconds.
+        """
+        with self._lock:
+            self._ejected[uri] = time.time() + self.retry
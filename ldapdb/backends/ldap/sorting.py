@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# 
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# All rights reserved.
+# 
+# See AUTHORS file for a full list of contributors.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, 
+#        this list of conditions and the following disclaimer.
+#     
+#     2. Redistributions in binary form must reproduce the above copyright 
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of Bolloré telecom nor the names of its contributors
+#        may be used to endorse or promote products derived from this software
+#        without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import heapq
+import itertools
+import marshal
+import tempfile
+
+
+def external_sort(entries, key, run_size):
+    """
+    Yields the (dn, attrs) tuples sorted by key, keeping at most run_size of
+    them in memory: runs of entries are sorted and written to temporary
+    files, which are then merged. The sort is stable.
+    """
+    entries = iter(entries)
+    runs = []
+    try:
+        while True:
+            run = list(itertools.islice(entries, run_size))
+            if not run:
+                break
+            run.sort(key=key)
+            if not runs and len(run) < run_size:
+                # everything fits in memory
+                for entry in run:
+                    yield entry
+                return
+            runs.append(_spill(run))
+        del run
+
+        # ties are broken by run and position so that entries themselves
+        # are never compared
+        merged = heapq.merge(*[_decorate(_load(f), key, i)
+                               for i, f in enumerate(runs)])
+        for k, i, pos, entry in merged:
+            yield entry
+    finally:
+        for f in runs:
+            f.close()
+
+
+def _spill(run):
+    f = tempfile.TemporaryFile()
+    for entry in run:
+        marshal.dump(entry, f)
+    f.seek(0)
+    return f
+
+
+def _load(f):
+    while True:
+        try:
+            yield marshal.load(f)
+        except EOFError:
+            return
+
+
+def _decorate(entries, key, run):
+    for pos, entry in enumerate(entries):
+        yield key(entry), run, pos, entry
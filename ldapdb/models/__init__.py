@@ -32,4 +32,4 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-from ldapdb.models.base import Model
+from ldapdb.models.base import BulkError, ConflictError, Model
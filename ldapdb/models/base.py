@@ -36,6 +36,9 @@ from django.conf import settings
 from django.core import exceptions
 from django.db import connections, router
 from django.db.models import signals
+from django.db.models import query_utils
+from django.db.models.query_utils import deferred_class_factory
+import copy
 import django.db.models
 import ldap
 import logging
@@ -43,6 +46,151 @@ import logging
 logger = logging.getLogger('ldapdb')
 
 
+class BulkError(Exception):
+    """
+    Raised when some of the operations of a bulk request failed. The errors
+    attribute holds a list of (object, exception) tuples.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super(BulkError, self).__init__(
+            "%d operation(s) failed, first error: %s" % (len(errors), errors[0][1]))
+
+
+class ConflictError(Exception):
+    """
+    Raised by Model.save(check_conflicts=True) when fields being saved were
+    modified in the directory since the instance was loaded. The fields
+    attribute holds the names of these fields.
+    """
+    def __init__(self, dn, fields):
+        self.dn = dn
+        self.fields = fields
+        super(ConflictError, self).__init__(
+            "LDAP entry %s was modified concurrently: %s" % (dn, ', '.join(fields)))
+
+
+class DeferredAttribute(query_utils.DeferredAttribute):
+    """
+    Loads all the deferred fields of an entry with a single base search
+    when one of them is first accessed.
+    """
+    def __get__(self, instance, owner):
+        data = instance.__dict__
+        if data.get(self.field_name, self) is self:
+            instance._load_deferred()
+        return data[self.field_name]
+
+
+class AsyncQuery(object):
+    """
+    A queryset being evaluated by the server, see QuerySet.aiter(),
+    acount() and aget().
+
+    poll() never blocks: it returns the objects received since the last
+    call, except for ordered querysets whose objects are all returned once
+    the search is complete. At that point done is True and result holds
+    the list of objects, the count or the single object. fileno() can be
+    used to wait for incoming data, as with AsyncSearch.
+    """
+    def __init__(self, queryset, mode='iter'):
+        self.queryset = queryset
+        self.mode = mode
+        self.done = False
+        self.result = None
+        self._compiler = queryset.query.get_compiler(queryset.db)
+        self._fields = self._compiler.get_fields()
+        self._ordering = self._compiler.get_ordering() if mode != 'count' else []
+        self._objects = []
+        self._entries = []
+        self._count = 0
+        self._pos = 0
+
+        # instances of the deferred class when only() or defer() are used
+        attnames = [field.attname for field in self._fields]
+        skip = set(field.attname for field in queryset.model._meta.concrete_fields) - set(attnames)
+        self._model = deferred_class_factory(queryset.model, skip) if skip else queryset.model
+        self._attnames = attnames
+
+        attrlist = ['1.1'] if mode == 'count' else self._compiler.get_attrlist(self._fields)
+        # the search is abandoned once the end of the slice is reached
+        self._search = self._compiler.search_async(attrlist)
+        if self._search is None:
+            self._finish()
+
+    def fileno(self):
+        return self._search.fileno()
+
+    def abandon(self):
+        if self._search is not None:
+            self._search.abandon()
+        self.done = True
+
+    def poll(self):
+        if self.done:
+            return []
+        try:
+            entries = self._search.poll()
+        except ldap.NO_SUCH_OBJECT:
+            entries = []
+
+        low_mark, high_mark = self.queryset.query.low_mark, self.queryset.query.high_mark
+        if self.mode == 'count':
+            # only the number of entries within the slice is kept
+            start, self._pos = self._pos, self._pos + len(entries)
+            end = self._pos if high_mark is None else min(self._pos, high_mark)
+            self._count += max(0, end - max(start, low_mark))
+            if high_mark is not None and self._pos >= high_mark:
+                self._search.abandon()
+            if self._search.done:
+                self._finish()
+            return []
+
+        if self._ordering:
+            self._entries.extend(entries)
+            if not self._search.done:
+                return []
+            entries = self._compiler.sort_entries(self._entries, self._ordering, high_mark)
+
+        new = []
+        for dn, attrs in entries:
+            if high_mark is not None and self._pos >= high_mark:
+                self._search.abandon()
+                break
+            if self._pos >= low_mark:
+                new.append(self._build(dn, attrs))
+            self._pos += 1
+        self._objects.extend(new)
+
+        if self._search.done:
+            self._finish()
+        return new if self.mode == 'iter' else []
+
+    def _build(self, dn, attrs):
+        row = self._compiler.entry_row(dn, attrs, self._fields)
+        obj = self._model(**dict(zip(self._attnames, row)))
+        obj._state.db = self.queryset.db
+        obj._state.adding = False
+        return obj
+
+    def _finish(self):
+        self.done = True
+        if self.mode == 'count':
+            self.result = self._count
+        elif self.mode == 'get':
+            model = self.queryset.model
+            if not self._objects:
+                raise model.DoesNotExist(
+                    "%s matching query does not exist." % model._meta.object_name)
+            elif len(self._objects) > 1:
+                raise model.MultipleObjectsReturned(
+                    "get() returned more than one %s -- it returned %s!" % (
+                    model._meta.object_name, len(self._objects)))
+            self.result = self._objects[0]
+        else:
+            self.result = self._objects
+
+
 class QuerySet(django.db.models.query.QuerySet):
 
     def using(self, alias):
@@ -54,6 +202,74 @@ class QuerySet(django.db.models.query.QuerySet):
         clone._db = alias
         return clone
 
+    def aiter(self):
+        """
+        Sends the search without waiting for the results, and returns an
+        AsyncQuery to collect the objects.
+        """
+        return AsyncQuery(self)
+
+    def acount(self):
+        """
+        Sends the search without waiting for the results, and returns an
+        AsyncQuery whose result is the number of matching entries.
+        """
+        return AsyncQuery(self, mode='count')
+
+    def aget(self, *args, **kwargs):
+        """
+        Like get(), but returns an AsyncQuery whose result is the object.
+        Its poll() raises DoesNotExist or MultipleObjectsReturned once the
+        search is complete.
+        """
+        return AsyncQuery(self.filter(*args, **kwargs), mode='get')
+
+    def defer(self, *fields):
+        # the dn comes with every entry, and is needed to load the others
+        return super(QuerySet, self).defer(*[f for f in fields if f != 'dn'])
+
+    def only(self, *fields):
+        if fields == (None,):
+            return super(QuerySet, self).only(*fields)
+        return super(QuerySet, self).only('dn', *fields)
+
+    def bulk_create(self, objs, batch_size=None):
+        """
+        Creates the given entries, sending the add operations without
+        waiting for each result. At most batch_size operations are
+        outstanding at a time.
+
+        The dn of each created object is filled in. If some entries could
+        not be created, BulkError is raised once all the others are done.
+        """
+        # routes the writes through db_for_write()
+        self._for_write = True
+        using = self.db
+        connection = connections[using]
+        objs = list(objs)
+
+        requests = []
+        for obj in objs:
+            obj._state.db = using
+            new_dn = obj.build_dn()
+            requests.append(('add', new_dn, obj._build_entry(connection)))
+            logger.debug("Creating new LDAP entry %s" % new_dn)
+
+        errors = []
+        results = connection.pipeline(requests, window=batch_size)
+        for obj, (request, error) in zip(objs, results):
+            if error is not None:
+                errors.append((obj, error))
+                continue
+            obj.dn = request[1]
+            obj.saved_pk = obj.pk
+            obj._saved_values = obj._field_values()
+            obj._state.adding = False
+
+        if errors:
+            raise BulkError(errors)
+        return objs
+
 class ModelManager(django.db.models.manager.Manager):
 
     def get_queryset(self):
@@ -63,6 +279,15 @@ class ModelManager(django.db.models.manager.Manager):
     def using(self,alias):
         return self.get_queryset().using(alias)
 
+    def aiter(self):
+        return self.get_queryset().aiter()
+
+    def acount(self):
+        return self.get_queryset().acount()
+
+    def aget(self, *args, **kwargs):
+        return self.get_queryset().aget(*args, **kwargs)
+
 class Model(django.db.models.base.Model):
     """
     Base class for all LDAP models.
@@ -72,6 +297,9 @@ class Model(django.db.models.base.Model):
     base_dn = None
     search_scope = ldap.SCOPE_SUBTREE
     object_classes = ['top']
+    # answer queries from a local copy of the subtree, kept in sync in the
+    # background, instead of searching the directory
+    mirrored = False
 
     objects = ModelManager()
 
@@ -105,6 +333,17 @@ class Model(django.db.models.base.Model):
     def __init__(self, *args, **kwargs):
         super(Model, self).__init__(*args, **kwargs)
         self.saved_pk = self.pk
+        self._saved_values = self._field_values()
+
+    def _field_values(self):
+        """
+        Returns a copy of the loaded field values, keyed by attribute name.
+        Deferred fields which were never loaded are left out.
+        """
+        return dict((field.attname, copy.copy(self.__dict__[field.attname]))
+                    for field in self._meta.fields
+                    if field.editable and field.name != 'dn'
+                    and field.attname in self.__dict__)
 
     def build_rdn(self):
         """
@@ -125,6 +364,29 @@ class Model(django.db.models.base.Model):
         return "%s,%s" % (self.build_rdn(), self.base_dn)
         raise Exception("Could not build Distinguished Name")
 
+    def _build_entry(self, connection):
+        """
+        Build the list of attributes used to create this entry.
+        """
+        entry = [('objectClass', self.object_classes)]
+
+        fields = (field for field in self._meta.fields
+                  if field.name != 'dn')
+
+        for field in fields:
+            if not field.editable:
+                continue
+            if field.rel is not None:
+                value = getattr(self, field.attname, None)
+            else:
+                value = getattr(self, field.name)
+            if value or isinstance(value, bool):
+                entry.append(
+                    (field.db_column,
+                     field.get_db_prep_save(value, connection=connection))
+                )
+        return entry
+
     def delete(self, using=None):
         """
         Delete this entry.
@@ -135,37 +397,149 @@ class Model(django.db.models.base.Model):
         connection.delete_s(self.dn)
         signals.post_delete.send(sender=self.__class__, instance=self)
 
-    def save(self, using=None, **kwargs):
+    def asave(self, using=None):
+        """
+        Sends the creation or the modification of this entry without
+        waiting for the server, and returns an AsyncWrite whose poll()
+        returns True once it is saved. The instance is updated and
+        post_save is sent at that point.
+
+        Entries can't be renamed or moved this way, use save() for that.
+        """
+        using = using or router.db_for_write(self.__class__, instance=self)
+        connection = connections[using]
+        created = not self.dn
+        if created:
+            dn = self.build_dn()
+            request = ('add', dn, self._build_entry(connection))
+        else:
+            dn = self.dn
+            if self.base_dn not in dn or self.build_dn() != dn:
+                raise ValueError("Renaming LDAP entry %s requires save()" % dn)
+            request = ('modify', dn, self._changes(connection)[0])
+
+        def saved(error):
+            if error is None:
+                self.dn = dn
+                self.saved_pk = self.pk
+                self._saved_values = self._field_values()
+                self._state.db = using
+                self._state.adding = False
+                signals.post_save.send(sender=self.__class__, instance=self, created=created)
+
+        logger.debug("Sending %s of LDAP entry %s" % (request[0], dn))
+        return connection.write_async(request, saved)
+
+    def adelete(self, using=None):
+        """
+        Sends the deletion of this entry without waiting for the server, and
+        returns an AsyncWrite. post_delete is sent once it is deleted.
+        """
+        using = using or router.db_for_write(self.__class__, instance=self)
+
+        def deleted(error):
+            if error is None:
+                signals.post_delete.send(sender=self.__class__, instance=self)
+
+        logger.debug("Sending deletion of LDAP entry %s" % self.dn)
+        return connections[using].write_async(('delete', self.dn), deleted)
+
+    def _load_deferred(self):
+        """
+        Loads the fields which were deferred when the instance was fetched.
+        """
+        using = self._state.db or router.db_for_read(self.__class__, instance=self)
+        fields = [field for field in self._meta.fields
+                  if field.attname not in self.__dict__]
+        self._refresh(connections[using], fields)
+        for field in fields:
+            if field.attname not in self.__dict__:
+                raise self.DoesNotExist("LDAP entry %s does not exist" % self.dn)
+            if field.editable:
+                self._saved_values[field.attname] = copy.copy(self.__dict__[field.attname])
+
+    def _refresh(self, connection, fields, result=None):
+        """
+        Reloads the given fields, from the post-read control of the write
+        result if the server returned it, otherwise with a base search on
+        the main server, which replicas may not have caught up with yet.
+        """
+        entry = connection.read_entries(result)[1]
+        if entry is None:
+            entry = connection.read_entry(self.dn,
+                [field.db_column for field in fields])
+            if entry is None:
+                return
+        for field in fields:
+            setattr(self, field.attname,
+                    field.from_ldap(entry[1].get(field.db_column, []), connection=connection))
+
+    def _changes(self, connection, current=None):
+        """
+        Returns the modlist of the changes made since the instance was
+        loaded, and the names of the changed fields whose value in current
+        is neither the loaded nor the new one.
+
+        Instances which were not loaded from the directory, for instance
+        built with the dn of an existing entry, have nothing to compare
+        with: all their fields are written.
+        """
+        modlist = []
+        conflicts = []
+        fields = (field for field in self._meta.fields
+                  if field.name != 'dn')
+        for field in fields:
+            if not field.editable or field.attname not in self.__dict__:
+                continue
+            new_value = self.__dict__[field.attname]
+            if self._state.adding:
+                # replacing with no values removes the attribute if present
+                modlist.append((ldap.MOD_REPLACE, field.db_column,
+                                field.get_db_prep_save(new_value, connection=connection)
+                                if new_value or isinstance(new_value, bool) else None))
+                continue
+            old_value = self._saved_values.get(field.attname)
+            if old_value != new_value:
+                if current is not None and \
+                   current.get(field.attname) not in (old_value, new_value):
+                    conflicts.append(field.name)
+                if new_value or isinstance(new_value, bool):
+                    modlist.append((ldap.MOD_REPLACE, field.db_column, field.get_db_prep_save(new_value, connection=connection)))
+                elif old_value or isinstance(old_value, bool):
+                    modlist.append((ldap.MOD_DELETE, field.db_column, None))
+        return modlist, conflicts
+
+    def save(self, using=None, check_conflicts=False, refresh=False, **kwargs):
         """
         Saves the current instance.
+
+        Changes are computed against the values the instance was loaded
+        with. If check_conflicts is True, the entry is read back first and
+        ConflictError is raised if a field being saved was changed since.
+
+        If refresh is True, or a list of field names, these fields are
+        reloaded after the write, which picks up values generated by the
+        server. A post-read control is used when the server supports it.
         """
         using = using or router.db_for_write(self.__class__, instance=self)
         connection = connections[using]
+        refresh_fields = [field for field in self._meta.fields
+                          if field.name != 'dn' and hasattr(field, 'from_ldap')
+                          and (refresh is True or field.name in (refresh or []))]
+        serverctrls = None
+        if refresh_fields:
+            serverctrls = connection.read_controls(
+                post_read=[field.db_column for field in refresh_fields])
+        result = None
         if not self.dn:
             # create a new entry
             record_exists = False 
-            entry = [('objectClass', self.object_classes)]
             new_dn = self.build_dn()
             logger.debug(new_dn)
 
-            fields = (field for field in self._meta.fields
-                      if field.name != 'dn')
-
-            for field in fields:
-                if not field.editable:
-                    continue
-                if field.rel is not None:
-                    value = getattr(self, field.attname, None)
-                else:
-                    value = getattr(self, field.name)
-                if value or isinstance(value, bool):
-                    entry.append(
-                        (field.db_column,
-                         field.get_db_prep_save(value, connection=connection))
-                    )
-
             logger.debug("Creating new LDAP entry %s" % new_dn)
-            connection.add_s(new_dn, entry)
+            result = connection.add_s(new_dn, self._build_entry(connection),
+                                      serverctrls=serverctrls)
 
             # update object
             self.dn = new_dn
@@ -174,30 +548,23 @@ class Model(django.db.models.base.Model):
             # update an existing entry
             record_exists = True
             move_record = self.base_dn not in self.dn
-            modlist = []
-            # force use of alias in 'self.using' if any alias are sent in args.
-            try:
-                orig = self.__class__.objects.using(using or self._state.db ).get(pk=self.saved_pk)
-            except Exception:
-                raise ValueError,u"Unknow connection. Need a instance to know the connection."
-
-            fields = (field for field in self._meta.fields
-                      if field.name != 'dn')
-
-            for field in fields:
-                if not field.editable:
-                    continue
-                if field.rel is not None:
-                    old_value = getattr(orig, field.attname, None)
-                    new_value = getattr(self, field.attname, None)
-                else:
-                    old_value = getattr(orig, field.name, None)
-                    new_value = getattr(self, field.name, None)
-                if old_value != new_value:
-                    if new_value or isinstance(new_value, bool):
-                        modlist.append((ldap.MOD_REPLACE, field.db_column, field.get_db_prep_save(new_value, connection=connection)))
-                    elif old_value or isinstance(old_value, bool):
-                        modlist.append((ldap.MOD_DELETE, field.db_column, None))
+            current = None
+            if check_conflicts:
+                # read from the main server, a cached or replicated copy
+                # could be the stale version we are looking for
+                fields = [field for field in self._meta.fields
+                          if field.editable and field.name != 'dn'
+                          and hasattr(field, 'from_ldap')]
+                entry = connection.read_entry(self.dn, [field.db_column for field in fields])
+                if entry is None:
+                    raise self.DoesNotExist("LDAP entry %s does not exist" % self.dn)
+                current = dict((field.attname,
+                                field.from_ldap(entry[1].get(field.db_column, []), connection=connection))
+                               for field in fields)
+
+            modlist, conflicts = self._changes(connection, current)
+            if conflicts:
+                raise ConflictError(self.dn, conflicts)
 
             if len(modlist) or move_record:
                 # handle renaming or moving
@@ -218,12 +585,19 @@ class Model(django.db.models.base.Model):
                     self.dn = new_dn
             
                 logger.debug("Modifying existing LDAP entry %s" % self.dn)
-                connection.modify_s(self.dn, modlist)
+                result = connection.modify_s(self.dn, modlist,
+                                             serverctrls=serverctrls)
             else:
                 logger.debug("No changes to be saved to LDAP entry %s" % self.dn)
 
+        if refresh_fields:
+            self._refresh(connection, refresh_fields, result)
+
         # done
         self.saved_pk = self.pk
+        self._saved_values = self._field_values()
+        self._state.db = using
+        self._state.adding = False
         signals.post_save.send(sender=self.__class__, instance=self, created=(not record_exists))
 
     #@classmethod
@@ -256,3 +630,14 @@ class Model(django.db.models.base.Model):
 
     class Meta:
         abstract = True
+
+
+def _prepare_deferred(sender, **kwargs):
+    # the classes built for querysets with deferred fields load these fields
+    # together, instead of running one query per field
+    if getattr(sender, '_deferred', False) and issubclass(sender, Model):
+        for name, value in sender.__dict__.items():
+            if type(value) is query_utils.DeferredAttribute:
+                setattr(sender, name, DeferredAttribute(value.field_name, sender))
+
+signals.class_prepared.connect(_prepare_deferred)
@@ -37,6 +37,9 @@ from django.db.models import fields, SubfieldBase
 from ldapdb import escape_ldap_filter
 
 class CharField(fields.CharField):
+    # matching rule used for server side sorting
+    ordering_rule = 'caseIgnoreOrderingMatch'
+
     def __init__(self, *args, **kwargs):
         kwargs['max_length'] = 200
         super(CharField, self).__init__(*args, **kwargs)
@@ -103,6 +106,9 @@ class ImageField(fields.Field):
         raise TypeError("ImageField has invalid lookup: %s" % lookup_type)
 
 class IntegerField(fields.IntegerField):
+    # matching rule used for server side sorting
+    ordering_rule = 'integerOrderingMatch'
+
     def from_ldap(self, value, connection):
         if len(value) == 0:
             return 0
@@ -32,13 +32,110 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import ldap
+import ldap.ldapobject
+import unittest
+from ldap.controls import SimplePagedResultsControl
+
+from django.db import connections
 from django.test import TestCase
 from django.db.models.sql.where import Constraint, AND, OR, WhereNode
 
 from ldapdb import escape_ldap_filter
-from ldapdb.backends.ldap.compiler import where_as_ldap
+from ldapdb.backends.ldap import compiler, filters, pool
+from ldapdb.backends.ldap.cache import SearchCache, SharedSearchCache
+from ldapdb.backends.ldap.compiler import _Reversed, where_as_ldap, where_shape
+from ldapdb.backends.ldap.mirror import Mirror
+from ldapdb.backends.ldap.pool import ConnectionPool, PoolTimeout
+from ldapdb.backends.ldap.replicas import ReplicaSet
+from ldapdb.backends.ldap.sorting import external_sort
+from ldapdb.models import Model
 from ldapdb.models.fields import CharField, IntegerField, ListField
 
+class DummyConnection(object):
+    closed = False
+
+    def search_s(self, *args, **kwargs):
+        return [('', {})]
+
+    def unbind_s(self):
+        self.closed = True
+
+class DownConnection(DummyConnection):
+    def modify_ext_s(self, *args, **kwargs):
+        raise ldap.SERVER_DOWN()
+
+class PagedConnection(object):
+    """
+    Serves three pages of one entry each, recording the requests.
+    """
+    def __init__(self):
+        self.requests = []
+
+    def search_ext(self, base, scope, filterstr, attrlist, serverctrls):
+        self.requests.append((scope, serverctrls[0].size, serverctrls[0].cookie))
+        return len(self.requests)
+
+    def result3(self, msgid):
+        size, cookie = self.requests[-1][1:]
+        if not size:
+            return ldap.RES_SEARCH_RESULT, [], msgid, []
+        page = int(cookie or 0)
+        cookie = str(page + 1) if page < 2 else ''
+        return (ldap.RES_SEARCH_RESULT, [('cn=%d' % page, {})], msgid,
+                [SimplePagedResultsControl(False, 0, cookie)])
+
+class ReconnectingConnection(PagedConnection, ldap.ldapobject.ReconnectLDAPObject):
+    """
+    A paged connection whose server went away until it reconnects.
+    """
+    def __init__(self):
+        PagedConnection.__init__(self)
+        self._uri = 'ldap://localhost'
+        self.reconnects = []
+
+    def search_ext(self, *args, **kwargs):
+        if not self.reconnects:
+            raise ldap.SERVER_DOWN()
+        return PagedConnection.search_ext(self, *args, **kwargs)
+
+    def reconnect(self, uri):
+        self.reconnects.append(uri)
+
+class SortedGroup(Model):
+    base_dn = 'ou=groups,dc=nodomain'
+    object_classes = ['posixGroup']
+    gid = IntegerField(db_column='gidNumber', unique=True)
+    name = CharField(db_column='cn', max_length=200, primary_key=True)
+
+class VLVConnection(object):
+    """
+    Serves a virtual list view over a list of entries, recording the
+    requested offsets and counts.
+    """
+    def __init__(self, entries, error=None, result=0):
+        self.entries = entries
+        self.error = error
+        self.result = result
+        self.requests = []
+
+    def supports_control(self, oid):
+        return True
+
+    def search_ctrls(self, base, scope, filterstr, attrlist, serverctrls):
+        vlv_ctrl = serverctrls[1]
+        self.requests.append((vlv_ctrl.offset, vlv_ctrl.after_count))
+        if self.error is not None:
+            raise self.error
+        # past the end of the list, the view is positioned on the last entry
+        position = min(vlv_ctrl.offset, len(self.entries))
+        resp_ctrl = compiler.VLVResponseControl()
+        resp_ctrl.target_position = position
+        resp_ctrl.content_count = len(self.entries)
+        resp_ctrl.result = self.result
+        return (self.entries[position - 1:position + vlv_ctrl.after_count],
+                [resp_ctrl])
+
 class WhereTestCase(TestCase):
     def test_escape(self):
         self.assertEquals(escape_ldap_filter(u'fôöbàr'), u'fôöbàr')
@@ -155,3 +252,380 @@ class WhereTestCase(TestCase):
         where.add((Constraint("givenName", "givenName", CharField()), 'exact', "bar"), OR)
         self.assertEquals(where_as_ldap(where), ("(|(cn=foo)(givenName=bar))", []))
 
+    def test_shape(self):
+        def build(cn, names):
+            where = WhereNode()
+            where.add((Constraint("cn", "cn", CharField()), 'exact', cn), AND)
+            where.add((Constraint("memberUid", "memberUid", ListField()), 'in', names), AND)
+            return where_shape(where)
+
+        # queries differing only by their values share a template
+        shape, params = build("foo%s", ["a", "b"])
+        self.assertEquals(build("bar", ["c", "d"])[0], shape)
+        self.assertNotEquals(build("bar", ["c"])[0], shape)
+        self.assertNotEquals(build("bar", ["c", "c"])[0], shape)
+        template, order = filters.to_template(filters.normalize(shape))
+        self.assertEquals(template % tuple(params[i] for i in order),
+                          "(&(cn=foo%s)(|(memberUid=a)(memberUid=b)))")
+
+    def test_normalize(self):
+        where = WhereNode()
+        where.add((Constraint("cn", "cn", CharField()), 'startswith', "foo"), AND)
+        child = WhereNode()
+        child.add((Constraint("uid", "uid", IntegerField()), 'exact', 1), AND)
+        child.add((Constraint("cn", "cn", CharField()), 'startswith', "foo"), AND)
+        child.add((Constraint("givenName", "givenName", CharField()), 'in', ["bar"]), AND)
+        where.add(child, AND)
+        self.assertEquals(where_as_ldap(where), ("(&(uid=1)(givenName=bar)(cn=foo*))", []))
+
+        # an empty __in can't match anything
+        where.add((Constraint("cn", "cn", CharField()), 'in', []), OR)
+        self.assertEquals(where_as_ldap(where), ("(&(uid=1)(givenName=bar)(cn=foo*))", []))
+        where.add((Constraint("cn", "cn", CharField()), 'in', []), AND)
+        self.assertEquals(where_as_ldap(where), ("(|)", []))
+
+class SortKeyTestCase(TestCase):
+    def test_reversed(self):
+        keys = [['b', 1], ['a', 2], ['b', 3], ['a', 1]]
+        self.assertEquals(sorted(keys, key=lambda k: [k[0], _Reversed(k[1])]),
+                          [['a', 2], ['a', 1], ['b', 3], ['b', 1]])
+        self.assertEquals(sorted(keys, key=lambda k: [_Reversed(k[0]), k[1]]),
+                          [['b', 1], ['b', 3], ['a', 1], ['a', 2]])
+
+    def test_external_sort(self):
+        entries = [(u'cn=%d' % i, {'gidNumber': [str(i % 4)]}) for i in range(7)]
+        key = lambda entry: entry[1]['gidNumber']
+        for run_size in (2, 7, 10):
+            self.assertEquals(list(external_sort(entries, key, run_size)),
+                              sorted(entries, key=key))
+
+class PoolTestCase(TestCase):
+    def setUp(self):
+        self._connect = pool.connect
+        pool.connect = lambda uri, user, password: DummyConnection()
+
+    def tearDown(self):
+        pool.connect = self._connect
+
+    def test_reuse(self):
+        p = ConnectionPool('ldap://', '', '', max_size=1)
+        conn = p.acquire()
+        p.release(conn)
+        self.assertTrue(p.acquire() is conn)
+
+    def test_timeout(self):
+        p = ConnectionPool('ldap://', '', '', max_size=1, timeout=0)
+        conn = p.acquire()
+        self.assertRaises(PoolTimeout, p.acquire)
+
+        # discarding a connection frees a slot
+        p.discard(conn)
+        self.assertTrue(conn.closed)
+        self.assertFalse(p.acquire() is conn)
+
+    def test_recycle(self):
+        p = ConnectionPool('ldap://', '', '', min_size=1, max_size=2, max_idle=-1)
+        conn1 = p.acquire()
+        conn2 = p.acquire()
+        p.release(conn1)
+        p.release(conn2)
+
+        # the oldest idle connection is closed, MIN_SIZE are kept
+        conn = p.acquire()
+        self.assertTrue(conn1.closed)
+        self.assertFalse(conn2.closed)
+        self.assertTrue(conn is conn2)
+
+    def test_fill(self):
+        p = ConnectionPool('ldap://', '', '', min_size=2, max_size=3)
+        p.fill()
+        self.assertEquals(len(p._idle), 2)
+        # checked out connections count towards MIN_SIZE
+        conn = p.acquire()
+        p.fill()
+        self.assertEquals(len(p._idle), 1)
+
+    def test_connection_lost(self):
+        pool.connect = lambda uri, user, password: DownConnection()
+        connection = connections['ldap']
+        connection.close()
+        connection.settings_dict['POOL'] = {'MAX_SIZE': 1, 'TIMEOUT': 0}
+        try:
+            self.assertRaises(ldap.SERVER_DOWN, connection.modify_s, 'cn=foo,dc=nodomain', [])
+            conn = connection.connection
+            connection.close()
+
+            # the connection is closed instead of going back to the pool
+            self.assertTrue(conn.closed)
+            p = connection._get_pool(connection.settings_dict['NAME'])
+            self.assertFalse(p.acquire() is conn)
+        finally:
+            del connection.settings_dict['POOL']
+            pool._pools.clear()
+
+class ReplicaSetTestCase(TestCase):
+    def test_round_robin(self):
+        replicas = ReplicaSet(['ldap://a', 'ldap://b', 'ldap://c'])
+        self.assertEquals([replicas.choose() for i in range(4)],
+                          ['ldap://a', 'ldap://b', 'ldap://c', 'ldap://a'])
+
+    def test_least_outstanding(self):
+        replicas = ReplicaSet(['ldap://a', 'ldap://b'], strategy='least-outstanding')
+        replicas.begin('ldap://a')
+        self.assertEquals(replicas.choose(), 'ldap://b')
+        self.assertEquals(replicas.choose(), 'ldap://b')
+
+        replicas.end('ldap://a')
+        replicas.begin('ldap://b')
+        self.assertEquals(replicas.choose(), 'ldap://a')
+
+    def test_eject(self):
+        replicas = ReplicaSet(['ldap://a', 'ldap://b'], retry=60)
+        replicas.eject('ldap://a')
+        self.assertEquals([replicas.choose() for i in range(2)],
+                          ['ldap://b', 'ldap://b'])
+
+        replicas.eject('ldap://b')
+        self.assertEquals(replicas.choose(), None)
+
+        # ejected replicas are used again after the retry delay
+        replicas = ReplicaSet(['ldap://a', 'ldap://b'], retry=-1)
+        replicas.eject('ldap://a')
+        self.assertEquals(replicas.choose(), 'ldap://a')
+
+class PagedSearchTestCase(TestCase):
+    def test_scope(self):
+        connection = PagedConnection()
+        results = connections['ldap']._paged_search(
+            connection, 'dc=nodomain', ldap.SCOPE_ONELEVEL, '(objectClass=*)', None)
+        self.assertEquals([dn for dn, attrs in results], ['cn=0', 'cn=1', 'cn=2'])
+        self.assertEquals(connection.requests, [(ldap.SCOPE_ONELEVEL, 1000, ''),
+                                                (ldap.SCOPE_ONELEVEL, 1000, '1'),
+                                                (ldap.SCOPE_ONELEVEL, 1000, '2')])
+
+    def test_sizelimit(self):
+        connection = PagedConnection()
+        results = connections['ldap']._paged_search(
+            connection, 'dc=nodomain', ldap.SCOPE_SUBTREE, '(objectClass=*)', None,
+            sizelimit=1)
+        self.assertEquals([dn for dn, attrs in results], ['cn=0'])
+        # the server is told to release the search
+        self.assertEquals(connection.requests, [(ldap.SCOPE_SUBTREE, 1, ''),
+                                                (ldap.SCOPE_SUBTREE, 0, '1')])
+
+    def test_reconnect(self):
+        # the search is sent again once the connection is reopened
+        connection = ReconnectingConnection()
+        results = connections['ldap']._paged_search(
+            connection, 'dc=nodomain', ldap.SCOPE_SUBTREE, '(objectClass=*)', None)
+        self.assertEquals([dn for dn, attrs in results], ['cn=0', 'cn=1', 'cn=2'])
+        self.assertEquals(connection.reconnects, ['ldap://localhost'])
+
+@unittest.skipIf(compiler.VLVRequestControl is None,
+                 "virtual list views require python-ldap >= 2.4.21")
+class VLVSearchTestCase(TestCase):
+    entries = [('cn=group%d,ou=groups,dc=nodomain' % i, {}) for i in range(1, 6)]
+
+    def vlv_search(self, qs, connection):
+        return compiler.SQLCompiler(qs.query, connection, 'ldap').vlv_search(
+            '(objectClass=posixGroup)', ['cn'], ['name'])
+
+    def test_slice(self):
+        connection = VLVConnection(self.entries)
+        vals = self.vlv_search(SortedGroup.objects.all()[1:3], connection)
+        self.assertEquals(list(vals), self.entries[1:3])
+        # offsets are 1-based, the entries after the first one are counted
+        self.assertEquals(connection.requests, [(2, 1)])
+
+    def test_past_end(self):
+        connection = VLVConnection(self.entries)
+        self.assertEquals(self.vlv_search(SortedGroup.objects.all()[10:12], connection), [])
+        self.assertEquals(connection.requests, [(11, 1)])
+
+    def test_empty(self):
+        connection = VLVConnection(self.entries)
+        self.assertEquals(self.vlv_search(SortedGroup.objects.all()[2:2], connection), [])
+        self.assertEquals(connection.requests, [])
+
+    def test_fallback(self):
+        # no upper bound, the view can't be used
+        connection = VLVConnection(self.entries)
+        self.assertEquals(self.vlv_search(SortedGroup.objects.all()[1:], connection), None)
+        self.assertEquals(connection.requests, [])
+
+        connection = VLVConnection(self.entries, error=ldap.UNAVAILABLE_CRITICAL_EXTENSION())
+        self.assertEquals(self.vlv_search(SortedGroup.objects.all()[1:3], connection), None)
+
+        # unwillingToPerform reported in the response control
+        connection = VLVConnection(self.entries, result=53)
+        self.assertEquals(self.vlv_search(SortedGroup.objects.all()[1:3], connection), None)
+
+class SearchCacheTestCase(TestCase):
+    def _set(self, cache, key, results):
+        cache.set(cache.get(key)[1], results)
+
+    def test_lru(self):
+        cache = SearchCache(max_size=2)
+        self._set(cache, ('ou=a,dc=x', 1), ['a'])
+        self._set(cache, ('ou=b,dc=x', 1), ['b'])
+        self.assertEquals(cache.get(('ou=a,dc=x', 1))[0], ['a'])
+
+        # the least recently used search is evicted
+        self._set(cache, ('ou=c,dc=x', 1), ['c'])
+        self.assertEquals(cache.get(('ou=b,dc=x', 1))[0], None)
+        self.assertEquals(cache.stats(), {'hits': 1, 'misses': 4, 'evictions': 1, 'size': 2})
+
+    def test_timeout(self):
+        cache = SearchCache(timeout=-1)
+        self._set(cache, ('ou=a,dc=x', 1), ['a'])
+        self.assertEquals(cache.get(('ou=a,dc=x', 1))[0], None)
+
+    def test_invalidate(self):
+        cache = SearchCache()
+        for base in ['dc=x', 'ou=a,dc=x', 'cn=foo,ou=a,dc=x', 'ou=b,dc=x']:
+            self._set(cache, (base, 1), [base])
+        cache.invalidate('OU=a,dc=x')
+        self.assertEquals(cache.get(('dc=x', 1))[0], None)
+        self.assertEquals(cache.get(('ou=a,dc=x', 1))[0], None)
+        self.assertEquals(cache.get(('cn=foo,ou=a,dc=x', 1))[0], None)
+        self.assertEquals(cache.get(('ou=b,dc=x', 1))[0], ['ou=b,dc=x'])
+
+        # results of a search running during the write are not stored
+        results, token = cache.get(('ou=a,dc=x', 1))
+        cache.invalidate('cn=bar,ou=b,dc=x')
+        cache.set(token, ['a'])
+        self.assertEquals(cache.get(('ou=a,dc=x', 1))[0], None)
+
+    def test_copy(self):
+        cache = SearchCache()
+        results = [(u'cn=foo,ou=a,dc=x', {'cn': ['foo']})]
+        self._set(cache, ('ou=a,dc=x', 1), results)
+        results[0][1]['cn'].append('bar')
+        cache.get(('ou=a,dc=x', 1))[0][0][1]['cn'].append('baz')
+        self.assertEquals(cache.get(('ou=a,dc=x', 1))[0],
+                          [(u'cn=foo,ou=a,dc=x', {'cn': ['foo']})])
+
+class SharedSearchCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = SharedSearchCache('ldap', 'default', lock_timeout=0.1)
+        self.cache.cache.clear()
+
+    def _set(self, key, results):
+        token = self.cache.get(key)[1]
+        self.cache.set(token, results)
+        self.cache.release(token)
+
+    def test_get(self):
+        self._set(('ou=a,dc=x', 1), [(u'cn=foo,ou=a,dc=x', {'cn': ['foo']})])
+        self.assertEquals(self.cache.get(('ou=a,dc=x', 1))[0],
+                          [(u'cn=foo,ou=a,dc=x', {'cn': ['foo']})])
+        self.assertEquals(self.cache.stats(), {'hits': 1, 'misses': 1, 'waits': 0})
+
+    def test_invalidate(self):
+        for base in ['dc=x', 'ou=a,dc=x', 'cn=foo,ou=a,dc=x', 'ou=b,dc=x']:
+            self._set((base, 1), [base])
+        self.cache.invalidate('ou=a,dc=x')
+        self.assertEquals(self.cache.get(('dc=x', 1))[0], None)
+        self.assertEquals(self.cache.get(('ou=a,dc=x', 1))[0], None)
+        self.assertEquals(self.cache.get(('cn=foo,ou=a,dc=x', 1))[0], None)
+        self.assertEquals(self.cache.get(('ou=b,dc=x', 1))[0], ['ou=b,dc=x'])
+
+    def test_lock(self):
+        # the first process to miss takes the lock, the others do not wait
+        # longer than LOCK_TIMEOUT
+        results, token = self.cache.get(('ou=a,dc=x', 1))
+        self.assertEquals(self.cache.get(('ou=a,dc=x', 1))[0], None)
+        self.assertEquals(self.cache.stats()['waits'], 1)
+        self.cache.release(token)
+
+class FilterTestCase(TestCase):
+    def test_parse(self):
+        self.assertEquals(filters.parse('(&(objectClass=posixGroup)(cn=foo\\2a*))'),
+            ('&', (('=', 'objectClass', 'posixGroup'),
+                   ('substr', 'cn', ('foo*', '')))))
+        self.assertEquals(filters.parse('(!(|(uid=*)(gidNumber>=10)))'),
+            ('!', ('|', (('present', 'uid'), ('>=', 'gidNumber', '10')))))
+        self.assertRaises(ValueError, filters.parse, '(&(cn=foo)')
+        self.assertRaises(ValueError, filters.parse, '(cn:dn:=foo)')
+
+    def test_match(self):
+        index = filters.index_entry({
+            'objectClass': ['top', 'posixGroup'],
+            'cn': ['FooGroup'],
+            'gidNumber': ['1000'],
+        })
+        def match(filterstr):
+            return filters.match(filters.parse(filterstr), index)
+        self.assertTrue(match('(&(objectclass=posixGroup)(cn=foogroup))'))
+        self.assertTrue(match('(cn=f*gr*p)'))
+        self.assertFalse(match('(cn=*bar*)'))
+        self.assertTrue(match('(gidNumber>=999)'))
+        self.assertFalse(match('(gidNumber<=999)'))
+        self.assertTrue(match('(!(memberUid=*))'))
+
+    def test_normalize(self):
+        self.assertEquals(filters.normalize(filters.parse(
+            '(&(&(cn=foo*)(uid=1))(|(cn=a))(uid=1)(!(!(sn=*)))(|))')), filters.FALSE)
+        self.assertEquals(filters.to_string(filters.normalize(filters.parse(
+            '(&(&(cn=foo*)(uid=1))(|(cn=a))(uid=1)(!(!(sn=*)))(&))'))),
+            '(&(uid=1)(cn=a)(sn=*)(cn=foo*))')
+        self.assertEquals(filters.to_string(filters.normalize(filters.parse(
+            '(|(cn=a)(!(&))(cn=a))'))), '(cn=a)')
+
+    def test_split(self):
+        node = filters.parse('(&(objectClass=posixAccount)(|(uid=a)(uid=b)(uid=c))(cn=*))')
+        self.assertEquals([filters.to_string(chunk) for chunk in filters.split(node, 2)],
+                          ['(&(objectClass=posixAccount)(|(uid=a)(uid=b))(cn=*))',
+                           '(&(objectClass=posixAccount)(uid=c)(cn=*))'])
+        self.assertEquals(filters.split(node, 3), [node])
+        node = filters.parse('(|(uid=a)(uid=b)(uid=c))')
+        self.assertEquals([filters.to_string(chunk) for chunk in filters.split(node, 1)],
+                          ['(uid=a)', '(uid=b)', '(uid=c)'])
+
+class MirrorTestCase(TestCase):
+    def test_search(self):
+        mirror = Mirror('ldap://', '', '', 'ou=groups,dc=x')
+        mirror.store('1', 'cn=foo,ou=groups,dc=x', {'cn': ['foo']})
+        mirror.store('2', 'cn=bar,ou=sub,ou=groups,dc=x', {'cn': ['bar']})
+        self.assertEquals(mirror.search('ou=groups,dc=x', ldap.SCOPE_SUBTREE, '(cn=*)'), None)
+
+        mirror.ready = True
+        self.assertEquals(
+            sorted(dn for dn, attrs in mirror.search('ou=groups,dc=x', ldap.SCOPE_SUBTREE, '(cn=*)')),
+            [u'cn=bar,ou=sub,ou=groups,dc=x', u'cn=foo,ou=groups,dc=x'])
+        self.assertEquals(
+            [dn for dn, attrs in mirror.search('ou=groups,dc=x', ldap.SCOPE_ONELEVEL, '(cn=*)')],
+            [u'cn=foo,ou=groups,dc=x'])
+
+    def test_copy(self):
+        mirror = Mirror('ldap://', '', '', 'ou=groups,dc=x')
+        mirror.ready = True
+        mirror.store('1', 'cn=foo,ou=groups,dc=x', {'cn': ['foo']})
+        mirror.search('ou=groups,dc=x', ldap.SCOPE_SUBTREE, '(cn=*)')[0][1]['cn'].append('bar')
+        self.assertEquals(mirror.search('ou=groups,dc=x', ldap.SCOPE_SUBTREE, '(cn=*)'),
+                          [(u'cn=foo,ou=groups,dc=x', {'cn': ['foo']})])
+
+    def test_present(self):
+        mirror = Mirror('ldap://', '', '', 'ou=groups,dc=x')
+        mirror.ready = True
+        mirror.store('1', 'cn=foo,ou=groups,dc=x', {'cn': ['foo']})
+        mirror.store('2', 'cn=bar,ou=groups,dc=x', {'cn': ['bar']})
+
+        # entries not listed during a refresh were deleted
+        mirror.present(['2'])
+        mirror.present(None)
+        self.assertEquals(
+            [dn for dn, attrs in mirror.search('ou=groups,dc=x', ldap.SCOPE_SUBTREE, '(cn=*)')],
+            [u'cn=bar,ou=groups,dc=x'])
+
+    def test_unavailable(self):
+        mirror = Mirror('ldap://', '', '', 'ou=groups,dc=x')
+
+        def sync():
+            raise ldap.UNAVAILABLE_CRITICAL_EXTENSION({'desc': 'not supported'})
+        mirror._sync = sync
+
+        # the thread gives up instead of retrying
+        mirror._run()
+        self.assertTrue(mirror.unavailable)
+        self.assertEquals(mirror.search('ou=groups,dc=x', ldap.SCOPE_SUBTREE, '(cn=*)'), None)